@@ -0,0 +1,274 @@
+#!/usr/bin/python3
+
+import sys, os, io, json, time, getopt, random, tempfile, contextlib
+
+import gedcom_path
+
+class SyntheticGedcom:
+    first_names = {"M": ["Ola", "Olav", "Per", "Nils", "Lars", "Hans", "Jon", "Anders", "Erik", "Knut",
+                         "Johannes", "Peder", "Ole", "Kristian", "Halvor", "Gunnar"],
+                   "F": ["Kari", "Anne", "Berit", "Ingrid", "Marit", "Guri", "Sigrid", "Ragnhild", "Eli",
+                         "Maren", "Anna", "Kristine", "Helga", "Johanne", "Karen", "Randi"]}
+    last_names = ["Hansen", "Olsen", "Berg", "Dahl", "Haugen", "Lie", "Bakken", "Moen", "Strand",
+                  "Nilsen", "Larsen", "Lund", "Solberg", "Eide", "Aas", "Vik"]
+    months = ["JAN", "FEB", "MAR", "APR", "MAY", "JUN", "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]
+    date_formats = {"exact": 4, "month": 1, "year": 2, "about": 1, "range": 1, "dual": 1, "phrase": 1}
+
+    def __init__(self, size, generations=10, collapse_rate=0.1, duplicate_rate=0.02, date_formats=None, seed=1):
+        self.size = size
+        self.generations = generations
+        self.collapse_rate = collapse_rate
+        self.duplicate_rate = duplicate_rate
+        self.date_formats = date_formats if date_formats is not None else self.date_formats
+        self.random = random.Random(seed)
+        self.individuals = []
+        self.families = []
+
+    def format_date(self, year):
+        kind = self.random.choices(list(self.date_formats.keys()), list(self.date_formats.values()))[0]
+        month = self.random.choice(self.months)
+        if kind == "exact":
+            return str(self.random.randint(1, 28)) + " " + month + " " + str(year)
+        if kind == "month":
+            return month + " " + str(year)
+        if kind == "about":
+            return self.random.choice(["ABT", "CAL", "EST", "BEF", "AFT"]) + " " + str(year)
+        if kind == "range":
+            return "BET " + str(year - 1) + " AND " + str(year + 1)
+        if kind == "dual":
+            return "5 " + month + " " + str(year - 1) + "/" + str(year)[-2:]
+        if kind == "phrase":
+            return "INT " + str(year) + " (from church book)"
+        return str(year)
+
+    def misspell(self, name):
+        position = self.random.randrange(1, len(name))
+        return name[:position] + self.random.choice("aeiouhnr") + name[position + 1:]
+
+    def add_individual(self, gender, year, name=None):
+        if name is None:
+            name = self.random.choice(self.first_names[gender]) + " /" + self.random.choice(self.last_names) + "/"
+        individual = {"identifier": "@I" + str(len(self.individuals) + 1) + "@", "name": name, "gender": gender,
+                      "year": year, "famc": None, "fams": [], "clan": None}
+        self.individuals.append(individual)
+        return individual
+
+    def add_family(self, husband, wife):
+        family = {"identifier": "@F" + str(len(self.families) + 1) + "@", "husband": husband, "wife": wife,
+                  "children": []}
+        self.families.append(family)
+        husband["fams"].append(family["identifier"])
+        wife["fams"].append(family["identifier"])
+        return family
+
+    def pair(self, generation):
+        men = [i for i in generation if i["gender"] == "M"]
+        women = [i for i in generation if i["gender"] == "F"]
+        self.random.shuffle(men)
+        self.random.shuffle(women)
+        clans = {}
+        for i in women:
+            clans.setdefault(i["clan"], []).append(i)
+        couples = []
+        taken = set()
+        for husband in men:
+            wife = None
+            if self.random.random() < self.collapse_rate:
+                cousins = clans.get(husband["clan"], [])
+                while len(cousins) > 0 and id(cousins[-1]) in taken:
+                    cousins.pop()
+                if len(cousins) > 0:
+                    wife = cousins.pop()
+            while wife is None and len(women) > 0:
+                wife = women.pop()
+                if id(wife) in taken:
+                    wife = None
+            if wife is None:
+                break
+            taken.add(id(wife))
+            couples.append(self.add_family(husband, wife))
+        return couples
+
+    def generate(self):
+        per_generation = max(2, self.size // self.generations)
+        generation = []
+        for k in range(per_generation):
+            individual = self.add_individual("MF"[k % 2], 1600 + self.random.randint(0, 10))
+            individual["clan"] = k // 2
+            generation.append(individual)
+        while len(self.individuals) < self.size and len(generation) > 1:
+            families = self.pair(generation)
+            if len(families) == 0:
+                break
+            next_generation = []
+            for k in range(per_generation):
+                if len(self.individuals) >= self.size:
+                    break
+                family = self.random.choice(families)
+                year = max(family["husband"]["year"], family["wife"]["year"]) + self.random.randint(20, 35)
+                child = self.add_individual(self.random.choice("MF"), year)
+                child["famc"] = family["identifier"]
+                child["clan"] = family["husband"]["clan"]
+                family["children"].append(child)
+                next_generation.append(child)
+                if self.random.random() < self.duplicate_rate and len(self.individuals) < self.size:
+                    self.add_individual(child["gender"], year + self.random.randint(-1, 1), self.misspell(child["name"]))
+            generation = next_generation
+        return self
+
+    def write(self, stream):
+        stream.write("0 HEAD\n1 CHAR UTF-8\n")
+        for i in self.individuals:
+            stream.write("0 " + i["identifier"] + " INDI\n1 NAME " + i["name"] + "\n1 SEX " + i["gender"] + "\n")
+            stream.write("1 BIRT\n2 DATE " + self.format_date(i["year"]) + "\n")
+            if i["famc"] is not None:
+                stream.write("1 FAMC " + i["famc"] + "\n")
+            for f in i["fams"]:
+                stream.write("1 FAMS " + f + "\n")
+        for f in self.families:
+            stream.write("0 " + f["identifier"] + " FAM\n1 HUSB " + f["husband"]["identifier"] + "\n")
+            stream.write("1 WIFE " + f["wife"]["identifier"] + "\n")
+            for c in f["children"]:
+                stream.write("1 CHIL " + c["identifier"] + "\n")
+        stream.write("0 TRLR\n")
+
+class Benchmark:
+    def __init__(self, number_of_doubles=10, repeat=1):
+        self.number_of_doubles = number_of_doubles
+        self.repeat = repeat
+
+    def measure(self, function):
+        best = None
+        result = None
+        for i in range(self.repeat):
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = function()
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best, result
+
+    def run_file(self, filename):
+        timings = {}
+        def parse():
+            population = gedcom_path.Population()
+            with open(filename, 'r', errors='replace', encoding='utf-8-sig') as f:
+                gedcom_path.FileParser().parse_file(f, population)
+            return population
+        timings["parse_file"], population = self.measure(parse)
+        identifiers = list(population.get_identifiers())
+        descendent = identifiers[-1]
+        def find_longest_branch():
+            population.generation_depth = None
+            return population.find_longest_branch(descendent)
+        timings["find_longest_branch"], branch = self.measure(find_longest_branch)
+        # Synthetic names are not unique, so the branches are searched by identifier
+        timings["search_tree"], tree = self.measure(lambda: population.search_tree(branch[0], descendent) or [])
+        timings["get_doubles"], doubles = self.measure(
+            lambda: gedcom_path.IndividualDoubles().get_doubles(population, identifiers, self.number_of_doubles))
+        timings["unconnected_find"], unconnected = self.measure(
+            lambda: gedcom_path.UnconnectedIndividuals().find(population, descendent, False))
+        return {"individuals": len(identifiers), "branches": len(tree), "timings": timings}
+
+    def run(self, sizes, generator_options):
+        results = {}
+        with tempfile.TemporaryDirectory() as directory:
+            for size in sizes:
+                filename = os.path.join(directory, "synthetic_" + str(size) + ".ged")
+                with open(filename, 'w') as f:
+                    SyntheticGedcom(size, **generator_options).generate().write(f)
+                results[str(size)] = self.run_file(filename)
+                sys.stderr.write("Size " + str(size) + ": " + json.dumps(results[str(size)]["timings"]) + "\n")
+        return results
+
+    def compare(self, results, baseline, tolerance):
+        regressions = []
+        for size, result in results.items():
+            if size not in baseline:
+                continue
+            for name, elapsed in result["timings"].items():
+                reference = baseline[size]["timings"].get(name)
+                if reference is not None and elapsed > reference * (1 + tolerance):
+                    regressions.append((size, name, reference, elapsed))
+        return regressions
+
+def usage():
+    print('benchmark_gedcom_path.py -s <sizes> -o <file> -b <file>')
+    print('-s <list>   Comma separated population sizes (default = 1000,5000,20000)')
+    print('-g <number> Number of generations (default = 10)')
+    print('-c <rate>   Pedigree collapse rate, fraction of marriages between cousins (default = 0.1)')
+    print('-u <rate>   Name duplication rate, fraction of individuals with a misspelled double (default = 0.02)')
+    print('-m <list>   Date format mix, e.g. exact:4,year:2,range:1 (formats = ' +
+          ','.join(SyntheticGedcom.date_formats.keys()) + ')')
+    print('-r <number> Random seed (default = 1)')
+    print('-n <number> Repeat each measurement and keep the fastest (default = 1)')
+    print('-o <file>   Write results as JSON to <file>')
+    print('-b <file>   Compare results against baseline JSON <file>')
+    print('-t <number> Allowed slowdown against baseline (default = 0.25)')
+    print('-w <file>   Only write a synthetic GEDCOM file of the first size to <file>')
+
+def main(argv):
+    sizes = [1000, 5000, 20000]
+    generator_options = {"generations": 10, "collapse_rate": 0.1, "duplicate_rate": 0.02, "seed": 1}
+    repeat = 1
+    outputfile = None
+    baselinefile = None
+    tolerance = 0.25
+    gedcomfile = None
+    try:
+        opts, args = getopt.getopt(argv, "hb:c:g:m:n:o:r:s:t:u:w:")
+    except getopt.GetoptError:
+        usage()
+        sys.exit(2)
+    for opt, arg in opts:
+        if opt == '-h':
+            usage()
+            sys.exit()
+        elif opt == "-s":
+            sizes = [int(i) for i in arg.split(',')]
+        elif opt == "-g":
+            generator_options["generations"] = int(arg)
+        elif opt == "-c":
+            generator_options["collapse_rate"] = float(arg)
+        elif opt == "-u":
+            generator_options["duplicate_rate"] = float(arg)
+        elif opt == "-m":
+            generator_options["date_formats"] = dict((i.split(':')[0], float(i.split(':')[1])) for i in arg.split(','))
+        elif opt == "-r":
+            generator_options["seed"] = int(arg)
+        elif opt == "-n":
+            repeat = int(arg)
+        elif opt == "-o":
+            outputfile = arg
+        elif opt == "-b":
+            baselinefile = arg
+        elif opt == "-t":
+            tolerance = float(arg)
+        elif opt == "-w":
+            gedcomfile = arg
+
+    if gedcomfile is not None:
+        with open(gedcomfile, 'w') as f:
+            SyntheticGedcom(sizes[0], **generator_options).generate().write(f)
+        return
+
+    results = Benchmark(repeat=repeat).run(sizes, generator_options)
+    output = json.dumps({"options": generator_options, "results": results}, indent=2)
+    if outputfile is not None:
+        with open(outputfile, 'w') as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+    if baselinefile is not None:
+        with open(baselinefile) as f:
+            baseline = json.load(f)["results"]
+        regressions = Benchmark().compare(results, baseline, tolerance)
+        for size, name, reference, elapsed in regressions:
+            print("Regression at size " + size + ": " + name + " took " + "%.3f" % elapsed +
+                  "s (baseline " + "%.3f" % reference + "s)")
+        if len(regressions) > 0:
+            sys.exit(1)
+
+if __name__ == "__main__":
+   main(sys.argv[1:])
@@ -1,11 +1,85 @@
 #!/usr/bin/python3
 
-import sys, getopt, operator, datetime
+import sys, os, re, io, json, time, mmap, codecs, xml.sax.saxutils, getopt, array, calendar, contextlib, socketserver, datetime, csv, collections, heapq, functools, multiprocessing, pickle, hashlib, sqlite3, stat, bisect
 
 from fuzzywuzzy import process
 from fuzzywuzzy import fuzz
+from fuzzywuzzy import utils
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+class Profiler:
+    def __init__(self):
+        self.enabled = False
+        self.phases = []
+        self.counters = collections.Counter()
+        self.depth = 0
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        # Phases are listed in start order, a nested phase is part of the time of its parent
+        entry = {"phase": name, "depth": self.depth}
+        self.phases.append(entry)
+        self.depth += 1
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.depth -= 1
+            entry["seconds"] = round(time.perf_counter() - start, 6)
+            entry["peak_memory_kb"] = self.get_peak_memory()
+
+    def get_peak_memory(self):
+        # The peak resident size of the whole process so far, not of the phase alone
+        if resource is None:
+            return None
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    def count(self, name, value=1):
+        if self.enabled:
+            self.counters[name] += value
+
+    def to_dict(self):
+        return {"phases": self.phases, "total_seconds": round(self.get_total(), 6), "counters": dict(self.counters)}
+
+    def get_total(self):
+        return sum(i["seconds"] for i in self.phases if i["depth"] == 0)
+
+    def print_report(self, stream):
+        for i in self.phases:
+            stream.write("%-20s %10.3f s %12s kB peak RSS (process)\n" % ("  " * i["depth"] + i["phase"], i["seconds"],
+                                                                             i["peak_memory_kb"]))
+        stream.write("%-20s %10.3f s\n" % ("total", self.get_total()))
+        for name, value in sorted(self.counters.items()):
+            stream.write("%-30s %12d\n" % (name, value))
+
+profiler = Profiler()
+
+class LineCounter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.lines = 0
+    def write(self, text):
+        self.lines += text.count('\n')
+        return self.stream.write(text)
+    def flush(self):
+        self.stream.flush()
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
 
 class Family:
+    __slots__ = ("identifier", "population", "husbond", "wife", "children")
     def __init__(self, identifier, population):
         self.identifier = identifier
         self.population = population
@@ -29,44 +103,112 @@ class Family:
             self.wife = line_parser.command[1]
 
 class Date:
-    def __init__(self, date):
+    __slots__ = ("date", "earliest", "latest", "years")
+    def __init__(self, date, earliest=None, latest=None):
         self.date = date
+        self.earliest = earliest
+        self.latest = latest
+        self.years = None
+        if earliest is not None:
+            self.years = (datetime.date.fromordinal(earliest).year, datetime.date.fromordinal(latest).year)
     def is_datetime(self):
-        return isinstance(self.date, datetime.datetime)
+        return self.years is not None
+    def get_year_range(self):
+        return self.years
     def get_year(self):
-        if self.is_datetime():
-            return self.date.date().year
+        if self.years is not None and self.years[0] == self.years[1]:
+            return self.years[0]
         return None
     def __str__(self):
-        if self.is_datetime():
-            return str(self.get_year())
+        year = self.get_year()
+        if year is not None:
+            return str(year)
         else:
-            return self.date
+            return self.date if self.date is not None else ""
     def year_difference(self, date):
         if date is not None:
-            y1 = self.get_year()
-            y2 = date.get_year()
+            y1 = self.get_year_range()
+            y2 = date.get_year_range()
             if y1 is not None and y2 is not None:
-                return abs(y1 - y2)
+                return max(0, y1[0] - y2[1], y2[0] - y1[1])
         return None
     def is_year_difference_below(self, data, limit):
         d = self.year_difference(data)
         if d is not None:
             return (d < limit)
         return None
-    
+
 class DateParser:
+    months = dict((m, i + 1) for i, m in enumerate(["JAN", "FEB", "MAR", "APR", "MAY", "JUN",
+                                                     "JUL", "AUG", "SEP", "OCT", "NOV", "DEC"]))
+    calendars = (None, "GREGORIAN", "JULIAN")
+    date_pattern = re.compile(r"(?:@#D([A-Z ]+)@\s*)?(?:(\d{1,2})\s+)?(?:([A-Z]{3,4})\s+)?"
+                              r"(\d{1,4})(?:/(\d{1,4}))?(\s*B\.?C\.?)?$")
+    range_pattern = re.compile(r"(?:BET|FROM)\s+(.+?)\s+(?:AND|TO)\s+(.+)$")
+    qualifier_pattern = re.compile(r"(?:ABT|CAL|EST|BEF|AFT|FROM|TO|INT)\s+(.+)$")
+    phrase_pattern = re.compile(r"(.*?)\s*\(.*\)$")
+    cache = collections.OrderedDict()
+    cache_size = 100000
+
+    def _parse_date(self, text):
+        match = self.date_pattern.match(text)
+        if match is None:
+            return None
+        calendar_escape, day, month, year, dual_year, before_christ = match.groups()
+        if calendar_escape not in self.calendars or before_christ is not None:
+            return None
+        year = int(year)
+        if dual_year is not None:
+            first_year = year
+            year = int(str(year)[:-len(dual_year)] + dual_year)
+            if year < first_year:
+                year += 10 ** len(dual_year)
+        try:
+            if month is None:
+                if day is not None:
+                    return None
+                return (datetime.date(year, 1, 1).toordinal(), datetime.date(year, 12, 31).toordinal())
+            month = self.months[month]
+            if day is None:
+                last_day = calendar.monthrange(year, month)[1]
+                return (datetime.date(year, month, 1).toordinal(), datetime.date(year, month, last_day).toordinal())
+            ordinal = datetime.date(year, month, int(day)).toordinal()
+            return (ordinal, ordinal)
+        except (KeyError, ValueError):
+            return None
+
     def _parse(self, date):
-        supported_formats = ["%d %b %Y", "%b %Y", "%Y", "ABT %Y", "AFT %Y", "BEF %Y"]
-        for i in supported_formats:
-            try:
-                parsed_date = datetime.datetime.strptime(date, i)
-                return parsed_date
-            except ValueError:
-                pass
-        return date
+        text = date.strip().upper()
+        match = self.phrase_pattern.match(text)
+        if match is not None:
+            text = match.group(1)
+        match = self.range_pattern.match(text)
+        if match is not None:
+            first = self._parse_date(match.group(1))
+            last = self._parse_date(match.group(2))
+            if first is None or last is None:
+                return None
+            return (min(first[0], last[0]), max(first[1], last[1]))
+        match = self.qualifier_pattern.match(text)
+        if match is not None:
+            text = match.group(1)
+        return self._parse_date(text)
+
     def parse(self, date):
-        return Date(self._parse(date))
+        parsed_date = self.cache.get(date)
+        if parsed_date is not None:
+            self.cache.move_to_end(date)
+        else:
+            ordinals = self._parse(date) if date is not None else None
+            if ordinals is None:
+                parsed_date = Date(date)
+            else:
+                parsed_date = Date(date, ordinals[0], ordinals[1])
+            if date is not None:
+                self.cache[date] = parsed_date
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        return parsed_date
     
 class IndividualBirthParser:
     def __init__(self, line_parser):
@@ -81,28 +223,28 @@ class IndividualBirthParser:
         return self
     
 class Individual:
+    __slots__ = ("identifier", "name", "name_prefix", "families", "parent_family", "extra_parent_families",
+                 "gender", "birthday", "_birth_parser", "married_name", "occupation")
     def __init__(self, identifier):
         self.identifier = identifier
         self.name = None
         self.name_prefix = None
-        self.children = []
-        self.father = None
-        self.mother = None
-        self.spouses = []
         self.families = []
         self.parent_family = None
+        self.extra_parent_families = None
         self.gender = None
         self.birthday = None
         self._birth_parser = None
         self.married_name = None
         self.occupation = []
     def __repr__(self):
-        return self.name + ", children = " + str(self.children)
+        return str(self.name) + "(" + self.identifier + ")"
     def parse_command(self, line_parser):
         if self._birth_parser is not None:
             if self._birth_parser.parse_command(line_parser) is None:
-                self.birthday = self._birth_parser.date
                 self._birth_parser = None
+            elif self._birth_parser.date is not None:
+                self.birthday = self._birth_parser.date
         if self._birth_parser is None:
             try:
                 if line_parser.command[0] == "BIRT":
@@ -115,8 +257,12 @@ class Individual:
                 elif line_parser.command[0] == "FAMS":
                     self.families.append(line_parser.command[1])
                 elif line_parser.command[0] == "FAMC":
-                    assert self.parent_family is None
-                    self.parent_family = line_parser.command[1]
+                    if self.parent_family is None:
+                        self.parent_family = line_parser.command[1]
+                    else:
+                        if self.extra_parent_families is None:
+                            self.extra_parent_families = []
+                        self.extra_parent_families.append(line_parser.command[1])
                 elif line_parser.command[0] == "SEX":
                     self.gender = line_parser.command[1]
                 elif line_parser.command[0] == "_MARNM":
@@ -128,24 +274,272 @@ class Individual:
             except IndexError:
                 pass
 
+class NameIndex:
+    shortlist_size = 100
+
+    def __init__(self, names):
+        self.identifiers = {}
+        for i, name in names:
+            if name is not None:
+                self.identifiers.setdefault(name, []).append(i)
+        self.names = list(self.identifiers.keys())
+        self.ngrams = {}
+        for position, name in enumerate(self.names):
+            for ngram in self.get_ngrams(name):
+                self.ngrams.setdefault(ngram, []).append(position)
+
+    def get_ngrams(self, name):
+        text = " " + utils.full_process(name) + " "
+        return set(text[i:i + 3] for i in range(len(text) - 2))
+
+    def get_identifiers(self, name):
+        return self.identifiers.get(name, [])
+
+    def get_candidates(self, name):
+        counts = collections.Counter()
+        for ngram in self.get_ngrams(name):
+            counts.update(self.ngrams.get(ngram, ()))
+        shortlist = sorted(position for position, count in counts.most_common(self.shortlist_size))
+        return [self.names[position] for position in shortlist]
+
+    def find_closest_match(self, name):
+        candidates = self.get_candidates(name)
+        if len(candidates) == 0:
+            candidates = self.names
+        match = process.extractOne(name, candidates)
+        return match[0] if match is not None else None
+
+class GenerationDepth:
+    def __init__(self, population):
+        self.population = population
+        self.depth = array.array('i', [0]) * population.get_size()
+        self.predecessor = array.array('i', [-1]) * population.get_size()
+
+    def compute(self, index):
+        depth = self.depth
+        stack = [index]
+        visiting = set()
+        while len(stack) > 0:
+            x = stack[-1]
+            if depth[x] > 0:
+                stack.pop()
+                continue
+            if x not in visiting:
+                visiting.add(x)
+                for parent in self.population.get_parent_ids(x):
+                    if parent >= 0 and depth[parent] == 0 and parent not in visiting:
+                        stack.append(parent)
+                continue
+            stack.pop()
+            best = 1
+            for parent in self.population.get_parent_ids(x):
+                if parent >= 0 and depth[parent] + 1 > best:
+                    best = depth[parent] + 1
+                    self.predecessor[x] = parent
+            depth[x] = best
+        return depth[index]
+
+    def get_branch(self, identifier):
+        index = self.population.get_id(identifier)
+        self.compute(index)
+        branch = []
+        while index >= 0:
+            branch.append(self.population.get_identifier_at(index))
+            index = self.predecessor[index]
+        branch.reverse()
+        return branch
+
+class AncestorIndex:
+    def __init__(self, population):
+        self.population = population
+        size = population.get_size()
+        self.order = self.get_order(population, size)
+        none = array.array('i')
+        self.ancestors = [none] * size
+        # Siblings have the same ancestors, so they share one array
+        families = {}
+        for x in self.order:
+            parents = population.get_parent_ids(x)
+            if parents == (-1, -1):
+                continue
+            ancestors = families.get(parents)
+            if ancestors is None:
+                ancestors = set()
+                for parent in parents:
+                    if parent >= 0:
+                        ancestors.update(self.ancestors[parent])
+                        ancestors.add(parent)
+                ancestors = families[parents] = array.array('i', sorted(ancestors))
+            self.ancestors[x] = ancestors
+
+    def get_order(self, population, size):
+        # Parents come before their children, a parent cycle is broken where it is found
+        state = bytearray(size)
+        order = array.array('i')
+        for root in range(size):
+            if state[root]:
+                continue
+            stack = [root]
+            while len(stack) > 0:
+                x = stack[-1]
+                if state[x] == 0:
+                    state[x] = 1
+                    for parent in population.get_parent_ids(x):
+                        if parent >= 0 and state[parent] == 0:
+                            stack.append(parent)
+                else:
+                    stack.pop()
+                    if state[x] == 1:
+                        state[x] = 2
+                        order.append(x)
+        return order
+
+    def is_ancestor(self, ancestor, descendant):
+        ancestors = self.ancestors[descendant]
+        position = bisect.bisect_left(ancestors, ancestor)
+        return position < len(ancestors) and ancestors[position] == ancestor
+
+    def get_ancestors(self, index, include_self=False):
+        ancestors = list(self.ancestors[index])
+        if include_self:
+            ancestors.append(index)
+        return ancestors
+
+    def get_common_ids(self, a, b):
+        common = set(self.ancestors[a]).intersection(self.ancestors[b])
+        if a == b or self.is_ancestor(a, b):
+            common.add(a)
+        if self.is_ancestor(b, a):
+            common.add(b)
+        return common
+
+    def get_common_ancestors(self, a, b):
+        common = self.get_common_ids(a, b)
+        lowest = [x for x in common if not any(i in common for i in self.population.get_child_ids(x))]
+        return sorted(lowest)
+
+    def get_generations(self, ancestor, descendant):
+        if ancestor == descendant:
+            return 0
+        if not self.is_ancestor(ancestor, descendant):
+            return None
+        frontier = [descendant]
+        generations = 0
+        while len(frontier) > 0:
+            generations += 1
+            next_frontier = set()
+            for x in frontier:
+                for parent in self.population.get_parent_ids(x):
+                    if parent == ancestor:
+                        return generations
+                    if parent >= 0 and self.is_ancestor(ancestor, parent):
+                        next_frontier.add(parent)
+            frontier = next_frontier
+        return None
+
 class Population:
     def __init__(self):
         self.individuals = {}
+        self.families = {}
+        self.ids = {}
+        self.xrefs = []
+        self.fathers = array.array('i')
+        self.mothers = array.array('i')
+        self.child_edges = array.array('i')
+        self.spouse_edges = array.array('i')
+        self.adjacency = None
+        self.name_index = None
+        self.generation_depth = None
+        self.ancestor_index = None
+        self.double_attributes = None
+        self.birth_years = None
     def add_individual(self, individual):
+        if individual.identifier not in self.ids:
+            self.ids[individual.identifier] = len(self.xrefs)
+            self.xrefs.append(individual.identifier)
+            self.fathers.append(-1)
+            self.mothers.append(-1)
+            self.generation_depth = None
+            self.ancestor_index = None
         self.individuals[individual.identifier] = individual
+        self.name_index = None
+        self.double_attributes = None
+        self.birth_years = None
+    def add_family(self, family):
+        self.families[family.identifier] = family
+    def get_name_index(self):
+        if self.name_index is None:
+            self.name_index = NameIndex((i, self.get_name(i)) for i in self.get_identifiers())
+        return self.name_index
+    def get_birth_years(self):
+        if self.birth_years is None:
+            self.birth_years = [years for name, gender, years in self.get_attribute_rows()]
+        return self.birth_years
+    def get_attribute_rows(self):
+        for i in self.xrefs:
+            individual = self.individuals[i]
+            birthday = individual.birthday
+            yield individual.name, individual.gender, birthday.get_year_range() if birthday is not None else None
+    def get_double_attributes(self):
+        if self.double_attributes is None:
+            self.double_attributes = DoubleAttributes(self)
+        return self.double_attributes
+    def get_size(self):
+        return len(self.xrefs)
+    def get_id(self, identifier):
+        return self.ids.get(identifier, -1)
+    def get_identifier_at(self, index):
+        return self.xrefs[index] if index >= 0 else None
     def add_child(self, identifier, child):
-        if identifier is not None:
-            self.individuals[identifier].children.append(child)
+        if identifier in self.ids and child in self.ids:
+            self.child_edges.extend((self.ids[identifier], self.ids[child]))
+            self.adjacency = None
     def add_children(self, identifier, children):
         for i in children:
             self.add_child(identifier, i)
     def add_father(self, identifier, father):
-        self.individuals[identifier].father = father
+        if identifier in self.ids:
+            self.fathers[self.ids[identifier]] = self.get_id(father)
+            self.generation_depth = None
+            self.ancestor_index = None
     def add_mother(self, identifier, mother):
-        self.individuals[identifier].mother = mother
+        if identifier in self.ids:
+            self.mothers[self.ids[identifier]] = self.get_id(mother)
+            self.generation_depth = None
+            self.ancestor_index = None
     def add_spouse(self, identifier, spouse):
-        if None not in (identifier, spouse):
-            self.individuals[identifier].spouses.append(spouse)
+        if identifier in self.ids and spouse in self.ids:
+            self.spouse_edges.extend((self.ids[identifier], self.ids[spouse]))
+            self.adjacency = None
+    def _build_csr(self, edges):
+        size = len(self.xrefs)
+        offsets = array.array('i', [0]) * (size + 1)
+        for k in range(0, len(edges), 2):
+            offsets[edges[k] + 1] += 1
+        for k in range(size):
+            offsets[k + 1] += offsets[k]
+        targets = array.array('i', [0]) * (len(edges) // 2)
+        position = offsets[:-1]
+        for k in range(0, len(edges), 2):
+            source = edges[k]
+            targets[position[source]] = edges[k + 1]
+            position[source] += 1
+        return offsets, targets
+    def get_adjacency(self):
+        if self.adjacency is None:
+            self.adjacency = self._build_csr(self.child_edges) + self._build_csr(self.spouse_edges)
+        return self.adjacency
+    def get_child_ids(self, index):
+        offsets, targets = self.get_adjacency()[0:2]
+        return targets[offsets[index]:offsets[index + 1]]
+    def get_spouse_ids(self, index):
+        offsets, targets = self.get_adjacency()[2:4]
+        return targets[offsets[index]:offsets[index + 1]]
+    def get_parent_ids(self, index):
+        return (self.fathers[index], self.mothers[index])
+    def get_identifiers_at(self, indexes):
+        xrefs = self.xrefs
+        return [xrefs[i] for i in indexes]
     def get_individual(self, identifier):
         return self.individuals[identifier]
     def get_name(self, identifier):
@@ -181,98 +575,132 @@ class Population:
             identifiers = self.individuals.keys()
         return [self.get_name(i) for i in identifiers]
     def get_identifier(self, name):
-        for i in self.individuals.keys():
-            if name == self.individuals[i].name:
-                return self.individuals[i].identifier
-        return None
+        identifiers = self.get_name_index().get_identifiers(name)
+        return identifiers[0] if len(identifiers) > 0 else None
     def get_identifiers(self):
         return self.individuals.keys()
     def is_identifier(self, identifier):
         return identifier in self.individuals.keys()
     def find_closest_match(self, name):
-        return process.extractOne(name, self.get_names())[0]
+        return self.get_name_index().find_closest_match(name)
     def get_children(self, identifier):
-        return self.get_individual(identifier).children
+        return self.get_identifiers_at(self.get_child_ids(self.ids[identifier]))
     def get_father(self, identifier):
-        return self.get_individual(identifier).father
+        return self.get_identifier_at(self.fathers[self.ids[identifier]])
     def get_mother(self, identifier):
-        return self.get_individual(identifier).mother
+        return self.get_identifier_at(self.mothers[self.ids[identifier]])
     def get_parents(self, identifier):
         return [self.get_father(identifier), self.get_mother(identifier)]
     def get_spouses(self, identifier):
-        return self.get_individual(identifier).spouses
+        return self.get_identifiers_at(self.get_spouse_ids(self.ids[identifier]))
     def get_family_members(self, identifier):
-        x = self.get_children(identifier).copy()
+        x = self.get_children(identifier)
         x.extend(self.get_parents(identifier))
         x.extend(self.get_spouses(identifier))
         return x
+    def get_display_name(self, identifier):
+        name = self.get_name(identifier)
+        if name is None:
+            name = identifier
+        married_name = self.get_married_name(identifier)
+        if married_name is not None:
+            name += " (" + married_name + ")"
+        return name
     def get_name_and_id(self, identifier):
         return self.get_name(identifier) + "(" + identifier + ")"
     def print_info(self, identifier, print_family=False):
         print(self.get_individual(identifier).name)
 
-    def search_ancester_tree(self, id, descendent_id):
-        tree = None
-        if descendent_id == id:
-            tree = [[]]
-        else:
-            children = self.get_children(id)
-            if children is not None:
-                for child in children:
-                    child_tree = self.search_ancester_tree(child, descendent_id)
-                    if child_tree is not None:
-                        for i in child_tree:
-                            i.append(child)
-                        if tree is None:
-                            tree = child_tree
-                        else:
-                            tree.extend(child_tree)
-        return tree
+    def get_ancestors(self, identifier):
+        if self.ancestor_index is not None and self.is_identifier(identifier):
+            return set(self.get_identifiers_at(self.ancestor_index.get_ancestors(self.get_id(identifier))))
+        ancestors = set()
+        stack = [identifier]
+        while len(stack) > 0:
+            for parent in self.get_parents(stack.pop()):
+                if parent is not None and parent not in ancestors:
+                    ancestors.add(parent)
+                    stack.append(parent)
+        return ancestors
+
+    def build_ancestor_index(self):
+        with profiler.phase("ancestor_index"):
+            self.ancestor_index = AncestorIndex(self)
+        return self.ancestor_index
+
+    def _is_viable(self, identifier, required, on_path):
+        for r, ancestors in required.items():
+            if r not in on_path and r != identifier and identifier not in ancestors:
+                return False
+        return True
 
-    def search_tree(self, ancester_id, descendent_id):
-        tree = self.search_ancester_tree(ancester_id, descendent_id)
+    def search_ancester_tree(self, id, descendent_id, contains_ids=()):
+        relevant = self.get_ancestors(descendent_id)
+        relevant.add(descendent_id)
+        for i in contains_ids:
+            if i not in relevant:
+                return None
+        required = dict((i, self.get_ancestors(i)) for i in contains_ids)
+        if id not in relevant or not self._is_viable(id, required, ()):
+            return None
+        if id == descendent_id:
+            return [[]]
+        tree = []
+        path = [id]
+        on_path = set(path)
+        stack = [iter(self.get_children(id))]
+        explored = 0
+        while len(stack) > 0:
+            child = next(stack[-1], None)
+            if child is None:
+                stack.pop()
+                on_path.discard(path.pop())
+            elif child in relevant and child not in on_path and self._is_viable(child, required, on_path):
+                explored += 1
+                if child == descendent_id:
+                    tree.append([child] + path[:0:-1])
+                else:
+                    path.append(child)
+                    on_path.add(child)
+                    stack.append(iter(self.get_children(child)))
+        profiler.count("paths_explored", explored)
+        return tree if len(tree) > 0 else None
+
+    def search_tree(self, ancester_id, descendent_id, contains_ids=()):
+        tree = self.search_ancester_tree(ancester_id, descendent_id, contains_ids)
         if tree is not None:
             for i in tree:
                 i.append(ancester_id)
         return tree
 
-    def _search_next_generation(self, identifier):
-        parents = self.get_parents(identifier)
-        longest_branch = None
-        for i in parents:
-            if i is not None:
-                branch = self._search_next_generation(i)
-                assert branch is not None, "Branch of " + self.get_name(i) + " returned None"
-                if longest_branch is None or branch.levels > longest_branch.levels:
-                    longest_branch = branch
-        if longest_branch is None:
-            class Branch: pass
-            longest_branch = Branch()
-            longest_branch.levels = 1
-            longest_branch.branch = [identifier]
-        else:
-            longest_branch.levels += 1
-            longest_branch.branch.append(identifier)
-        return longest_branch
-                
+    def get_generation_depth(self):
+        if self.generation_depth is None:
+            self.generation_depth = GenerationDepth(self)
+        return self.generation_depth
+
     def find_longest_branch(self, root_identifier):
-        longest_path = self._search_next_generation(root_identifier)
-        return longest_path.branch
-    
+        return self.get_generation_depth().get_branch(root_identifier)
+
+    def find_longest_branches(self, root_identifiers):
+        generation_depth = self.get_generation_depth()
+        return [generation_depth.get_branch(i) for i in root_identifiers]
+
+    def resolve_identifier(self, name):
+        if self.is_identifier(name):
+            return name
+        return self.get_identifier(self.find_closest_match(name))
+
+    def match_branches(self, names):
+        matched_names = [self.find_closest_match(i) for i in names]
+        tree = self.get_branches(matched_names[-1], matched_names[0], matched_names[1:-1])
+        return matched_names, tree
+
     def get_branches(self, ancester_name, descendent_name, contains_names):
         ancester_id = self.get_identifier(ancester_name)
         descendent_id = self.get_identifier(descendent_name)
-        tree = self.search_tree(ancester_id, descendent_id)
-        matched_branches = []
-        if tree is not None:
-            for branch in tree:
-                matches = True
-                for x in contains_names:
-                    if self.get_identifier(x) not in branch:
-                        matches = False
-                if matches:
-                    matched_branches.append(branch)
-        return matched_branches
+        contains_ids = [self.get_identifier(x) for x in contains_names]
+        tree = self.search_tree(ancester_id, descendent_id, contains_ids)
+        return tree if tree is not None else []
 
     def default_when_none(self, text, default="unknown"):
         return str(text) if text is not None else default
@@ -284,49 +712,20 @@ class Population:
                     text = text[:limit] + "..."
         return text
     
-    def apply_format(self, identifier, format, occupation_limit=None):
-        x = format
-        name = self.get_name(identifier)
-        x = x.replace("%n", self.default_when_none(name))
-        x = x.replace("%g", self.get_gender(identifier))
-        x = x.replace("%p", self.default_when_none(self.get_name_prefix(identifier), ""))
-        x = x.replace("%b", self.default_when_none(self.get_birthday(identifier), ""))
+    def format_occupation(self, identifier, occupation_limit=None):
         try:
             occupation = self.get_occupation(identifier)[0]
-            occupation = self.limited_text(occupation, occupation_limit) + ", "
+            return self.limited_text(occupation, occupation_limit) + ", "
         except (IndexError, TypeError) as e:
-            occupation = ""
-        x = x.replace("%o", occupation)
-        return x
+            return ""
+
+    def apply_format(self, identifier, format, occupation_limit=None):
+        return OutputTemplate(self, format, occupation_limit).render(identifier)
     
-    def print_branches(self, tree, format, dot_format):
-        count = 1
-        dot_outputs = []
-        if dot_format:
-            print("digraph family_tree {")
-        for branch in tree:
-            if not dot_format:
-                print("# Branch number " + str(count))
-            previous_identifier = None
-            for x in branch:
-                if dot_format:
-                    if previous_identifier is not None:
-                        occupation_limit = 30
-                        n1 = self.apply_format(previous_identifier, format, occupation_limit).replace('"', '\'')
-                        n2 = self.apply_format(x, format, occupation_limit).replace('"', '\'')
-                        n = '"' + n1 + '" -> "' + n2 + '"'
-                        if n not in dot_outputs:
-                            print(n)
-                            dot_outputs.append(n)
-                    previous_identifier = x
-                else:
-                    print(self.apply_format(x, format))
-            count += 1
-            if not dot_format:
-                print("---------------------------------------------------")
-        if dot_format:
-            print("}")
-                
+    def print_branches(self, tree, format, output_format="text", stream=None):
+        writer = BranchWriter.create(output_format, self, format, stream if stream is not None else sys.stdout)
+        writer.write_branches(tree)
+
     def print_identifier(self, identifier):
         print("Name       = " + self.default_when_none(self.get_name(identifier)))
         print("Identifier = " + identifier)
@@ -340,182 +739,946 @@ class Population:
         print("Spouses    = " + str(self.get_names(self.get_spouses(identifier))))
         print("Children   = " + str(self.get_names(self.get_children(identifier))))
 
+class OutputTemplate:
+    field_pattern = re.compile(r"%([ngpbo])")
+
+    def __init__(self, population, format, occupation_limit=None, escape=None):
+        self.population = population
+        self.occupation_limit = occupation_limit
+        self.escape = escape
+        self.labels = {}
+        fields = {"n": lambda i: population.default_when_none(population.get_name(i)),
+                  "g": lambda i: population.default_when_none(population.get_gender(i), ""),
+                  "p": lambda i: population.default_when_none(population.get_name_prefix(i), ""),
+                  "b": lambda i: population.default_when_none(population.get_birthday(i), ""),
+                  "o": lambda i: population.format_occupation(i, occupation_limit)}
+        self.parts = []
+        for k, part in enumerate(self.field_pattern.split(format)):
+            if k % 2 == 1:
+                self.parts.append(fields[part])
+            elif len(part) > 0:
+                self.parts.append(part)
+
+    def render(self, identifier):
+        label = self.labels.get(identifier)
+        if label is None:
+            label = "".join(i if isinstance(i, str) else i(identifier) for i in self.parts)
+            if self.escape is not None:
+                label = self.escape(label)
+            self.labels[identifier] = label
+        return label
+
+class BranchWriter:
+    buffer_size = 65536
+
+    @staticmethod
+    def create(output_format, population, format, stream):
+        writers = {"text": BranchWriter, "dot": DotBranchWriter, "json": JsonBranchWriter,
+                   "graphml": GraphmlBranchWriter}
+        if output_format not in writers:
+            raise ValueError("Unknown output format: " + str(output_format))
+        return writers[output_format](population, format, stream)
+
+    def __init__(self, population, format, stream):
+        self.template = OutputTemplate(population, format)
+        self.stream = stream
+        self.lines = []
+
+    def emit(self, line):
+        self.lines.append(line)
+        if len(self.lines) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.lines) > 0:
+            self.lines.append("")
+            self.stream.write("\n".join(self.lines))
+            self.lines = []
+
+    def write_header(self):
+        pass
+
+    def write_footer(self):
+        pass
+
+    def write_branch(self, count, branch):
+        self.emit("# Branch number " + str(count))
+        for x in branch:
+            self.emit(self.template.render(x))
+        self.emit("---------------------------------------------------")
+
+    def write_branches(self, tree):
+        self.write_header()
+        for count, branch in enumerate(tree, 1):
+            self.write_branch(count, branch)
+        self.write_footer()
+        self.flush()
+        self.stream.flush()
+
+class DotBranchWriter(BranchWriter):
+    def __init__(self, population, format, stream):
+        BranchWriter.__init__(self, population, format, stream)
+        self.template = OutputTemplate(population, format, 30, lambda label: label.replace('"', '\''))
+        self.edges = set()
+
+    def write_header(self):
+        self.emit("digraph family_tree {")
+
+    def write_footer(self):
+        self.emit("}")
+
+    def write_branch(self, count, branch):
+        for k in range(1, len(branch)):
+            n = '"' + self.template.render(branch[k - 1]) + '" -> "' + self.template.render(branch[k]) + '"'
+            if n not in self.edges:
+                self.edges.add(n)
+                self.emit(n)
+
+class JsonBranchWriter(BranchWriter):
+    def __init__(self, population, format, stream):
+        BranchWriter.__init__(self, population, format, stream)
+        self.identifiers = {}
+
+    def write_header(self):
+        self.emit('{"branches": [')
+
+    def write_branch(self, count, branch):
+        for x in branch:
+            if x not in self.identifiers:
+                self.identifiers[x] = self.template.render(x)
+        self.emit(("" if count == 1 else ",") + json.dumps(branch))
+
+    def write_footer(self):
+        self.emit('], "individuals": ' + json.dumps(self.identifiers) + '}')
+
+class GraphmlBranchWriter(BranchWriter):
+    def __init__(self, population, format, stream):
+        BranchWriter.__init__(self, population, format, stream)
+        self.nodes = set()
+        self.edges = set()
+
+    def write_header(self):
+        self.emit('<?xml version="1.0" encoding="UTF-8"?>')
+        self.emit('<graphml xmlns="http://graphml.graphdrawing.org/xmlns">')
+        self.emit('<key id="label" for="node" attr.name="label" attr.type="string"/>')
+        self.emit('<graph id="family_tree" edgedefault="directed">')
+
+    def write_node(self, identifier):
+        if identifier not in self.nodes:
+            self.nodes.add(identifier)
+            self.emit('<node id=' + xml.sax.saxutils.quoteattr(identifier) + '><data key="label">' +
+                      xml.sax.saxutils.escape(self.template.render(identifier)) + '</data></node>')
+
+    def write_branch(self, count, branch):
+        for x in branch:
+            self.write_node(x)
+        for k in range(1, len(branch)):
+            edge = (branch[k - 1], branch[k])
+            if edge not in self.edges:
+                self.edges.add(edge)
+                self.emit('<edge source=' + xml.sax.saxutils.quoteattr(edge[0]) + ' target=' +
+                          xml.sax.saxutils.quoteattr(edge[1]) + '/>')
+
+    def write_footer(self):
+        self.emit('</graph>')
+        self.emit('</graphml>')
+
+class ValidationRule:
+    name = None
+
+    def __init__(self, population):
+        self.population = population
+
+    def check(self, index, individual):
+        return ()
+
+    def check_family(self, family):
+        return ()
+
+class ParentRule(ValidationRule):
+    def __init__(self, population):
+        ValidationRule.__init__(self, population)
+        self.years = population.get_birth_years()
+        self.parents = (("father", population.fathers), ("mother", population.mothers))
+
+    def check(self, index, individual):
+        years = self.years[index]
+        if years is None:
+            return ()
+        findings = []
+        for role, parents in self.parents:
+            parent = parents[index]
+            if parent >= 0 and self.years[parent] is not None:
+                message = self.check_parent(role, years, self.years[parent])
+                if message is not None:
+                    findings.append(role + " " + self.population.xrefs[parent] + message)
+        return findings
+
+    def check_parent(self, role, years, parent_years):
+        return None
+
+class GenderRule(ValidationRule):
+    name = "gender"
+
+    def check(self, index, individual):
+        if individual.gender in ('M', 'F'):
+            return ()
+        return ("gender is " + ("missing" if individual.gender is None else individual.gender),)
+
+class OccupationRule(ValidationRule):
+    name = "occupation"
+    occupation_text_limit = 100
+
+    def check(self, index, individual):
+        return ["occupation text exceeds " + str(self.occupation_text_limit) + " characters: " +
+                self.population.limited_text(i, 40) for i in individual.occupation
+                if i is not None and len(i) > self.occupation_text_limit]
+
+class BirthOrderRule(ParentRule):
+    name = "birth_order"
+
+    def check_parent(self, role, years, parent_years):
+        if years[1] < parent_years[0]:
+            return " was born after the child"
+        return None
+
+class ParentAgeRule(ParentRule):
+    name = "parent_age"
+    minimum_age = 12
+    maximum_age = {"father": 80, "mother": 55}
+
+    def check_parent(self, role, years, parent_years):
+        youngest = years[0] - parent_years[1]
+        oldest = years[1] - parent_years[0]
+        if 0 <= oldest < self.minimum_age:
+            return " was at most " + str(oldest) + " years old"
+        if youngest > self.maximum_age[role]:
+            return " was at least " + str(youngest) + " years old"
+        return None
+
+class DuplicateParentFamilyRule(ValidationRule):
+    name = "duplicate_famc"
+
+    def check(self, index, individual):
+        if individual.extra_parent_families is None:
+            return ()
+        return ("multiple FAMC: " + ", ".join([individual.parent_family] + individual.extra_parent_families),)
+
+class DanglingReferenceRule(ValidationRule):
+    name = "dangling_xref"
+
+    def check(self, index, individual):
+        families = self.population.families
+        if (individual.parent_family is None or individual.parent_family in families) and \
+           individual.extra_parent_families is None and all(i in families for i in individual.families):
+            return ()
+        findings = []
+        if individual.parent_family is not None:
+            for i in [individual.parent_family] + (individual.extra_parent_families or []):
+                if i not in families:
+                    findings.append("FAMC " + i + " does not exist")
+        for i in individual.families:
+            if i not in families:
+                findings.append("FAMS " + i + " does not exist")
+        return findings
+
+    def check_family(self, family):
+        ids = self.population.ids
+        if (family.husbond is None or family.husbond in ids) and (family.wife is None or family.wife in ids) and \
+           all(i in ids for i in family.children):
+            return ()
+        members = [("HUSB", family.husbond), ("WIFE", family.wife)] + [("CHIL", i) for i in family.children]
+        return [tag + " " + i + " does not exist" for tag, i in members if i is not None and i not in ids]
+
+def validate_identifiers(identifiers):
+    return PopulationValidator().check_identifiers(PopulationValidator.worker_population,
+                                                   PopulationValidator.worker_rules, identifiers)
+
+def set_validation_population(population, validation_options):
+    PopulationValidator.worker_population = population
+    PopulationValidator.worker_rules = PopulationValidator().get_rules(population, validation_options)
+
 class PopulationValidator:
-    def validate(self, population, validation_options, identifiers=None):
+    rules = {"gender": GenderRule, "occupation": OccupationRule, "birth_order": BirthOrderRule,
+             "parent_age": ParentAgeRule, "duplicate_famc": DuplicateParentFamilyRule,
+             "dangling_xref": DanglingReferenceRule}
+    chunk_size = 50000
+    worker_population = None
+    worker_rules = None
+
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+
+    def get_rule_names(self, validation_options):
+        if "all" in validation_options:
+            return list(self.rules.keys())
+        unknown = [i for i in validation_options if i not in self.rules]
+        if len(unknown) > 0:
+            raise ValueError("Unknown validation rule: " + ", ".join(unknown))
+        return list(dict.fromkeys(validation_options))
+
+    def get_rules(self, population, validation_options):
+        return [self.rules[i](population) for i in self.get_rule_names(validation_options)]
+
+    def check_identifiers(self, population, rules, identifiers):
+        individuals = population.individuals
+        ids = population.ids
+        checks = [(rule.name, rule.check) for rule in rules]
+        findings = []
+        for identifier in identifiers:
+            individual = individuals[identifier]
+            index = ids[identifier]
+            for name, check in checks:
+                for message in check(index, individual):
+                    findings.append((name, identifier, message))
+        return findings
+
+    def check_families(self, population, rules, identifiers):
         if identifiers is None:
-            identifiers = population.get_identifiers()
-        validate_gender = ("gender" in validation_options)
-        validate_occupation = ("occupation" in validation_options)
-        none_identifiers = 0
-        errors_in_gender = 0
-        occupation_text_limit = 100
-        for i in identifiers:
-            if i is not None:
-                if validate_gender:
-                    gender = population.get_gender(i) 
-                    if gender is None or gender not in ('M', 'F'):
-                        population.print_identifier(i)
-                        print("-----------------------------------------------")
-                        errors_in_gender += 1
-                if validate_occupation:
-                    name = population.get_name(i)
-                    if name is not None:
-                        for occupation in population.get_occupation(i):
-                            if occupation is not None and len(occupation) > occupation_text_limit:
-                                print(name + " occupation text exceeds limit:")
-                                print(occupation)
-                                print("-----------------------------------------------")
+            families = population.families.values()
+        else:
+            references = []
+            for i in identifiers:
+                individual = population.get_individual(i)
+                references.extend(individual.families)
+                if individual.parent_family is not None:
+                    references.append(individual.parent_family)
+            families = [population.families[i] for i in dict.fromkeys(references) if i in population.families]
+        findings = []
+        for family in families:
+            for rule in rules:
+                for message in rule.check_family(family):
+                    findings.append((rule.name, family.identifier, message))
+        return findings
+
+    def get_findings(self, population, validation_options, identifiers=None):
+        if identifiers is None:
+            checked = list(population.get_identifiers())
+        else:
+            checked = [i for i in identifiers if i is not None]
+        chunks = [checked[k:k + self.chunk_size] for k in range(0, len(checked), self.chunk_size)]
+        rules = self.get_rules(population, validation_options)
+        pool = None
+        if self.jobs > 1 and len(chunks) > 1:
+            pool = multiprocessing.Pool(self.jobs, set_validation_population, (population, validation_options))
+        try:
+            if pool is not None:
+                results = pool.imap(validate_identifiers, chunks)
             else:
-                none_identifiers += 1
-        if none_identifiers > 0:
-            print("Found " + str(none_identifiers) + " None identifier in population")
-        if errors_in_gender > 0:
-            print("Found " + str(errors_in_gender) + " errors in gender")
-            
+                results = map(functools.partial(self.check_identifiers, population, rules), chunks)
+            findings = [i for result in results for i in result]
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        findings.extend(self.check_families(population, rules, None if identifiers is None else checked))
+        profiler.count("validation_findings", len(findings))
+        return findings
+
+    def get_counts(self, validation_options, findings):
+        counts = dict((i, 0) for i in self.get_rule_names(validation_options))
+        for rule, identifier, message in findings:
+            counts[rule] += 1
+        return counts
+
+    def to_dicts(self, population, findings):
+        return [{"rule": rule, "identifier": identifier,
+                 "name": population.get_name(identifier) if identifier in population.ids else None,
+                 "message": message} for rule, identifier, message in findings]
+
+    def write_findings(self, population, validation_options, findings, output_format, stream):
+        output = io.StringIO()
+        counts = self.get_counts(validation_options, findings)
+        if output_format == "json":
+            json.dump({"findings": self.to_dicts(population, findings), "counts": counts}, output)
+            output.write("\n")
+        elif output_format == "csv":
+            writer = csv.writer(output, lineterminator="\n")
+            writer.writerow(["rule", "identifier", "name", "message"])
+            for i in self.to_dicts(population, findings):
+                writer.writerow([i["rule"], i["identifier"], i["name"], i["message"]])
+        else:
+            for i in self.to_dicts(population, findings):
+                name = " " + i["name"] if i["name"] is not None else ""
+                output.write(i["identifier"] + name + ": " + i["message"] + " (" + i["rule"] + ")\n")
+            for rule, count in counts.items():
+                if count > 0:
+                    output.write("Found " + str(count) + " errors in " + rule + "\n")
+        stream.write(output.getvalue())
+
+    def validate(self, population, validation_options, identifiers=None, output_format="text", stream=None):
+        findings = self.get_findings(population, validation_options, identifiers)
+        self.write_findings(population, validation_options, findings, output_format,
+                            stream if stream is not None else sys.stdout)
+        return findings
+
+class DoubleAttributes:
+    def __init__(self, population):
+        blocks = {}
+        keys = []
+        earliest = []
+        latest = []
+        lengths = []
+        for name, gender, years in population.get_attribute_rows():
+            if name is None or len(name) == 0 or years is None:
+                keys.append(-1)
+                years = (0, 0)
+            else:
+                keys.append(blocks.setdefault((gender, name[0].upper()), len(blocks)))
+            earliest.append(years[0])
+            latest.append(years[1])
+            lengths.append(len(name) if name is not None else 0)
+        self.keys = numpy.array(keys, dtype=numpy.int64)
+        self.earliest = numpy.array(earliest, dtype=numpy.int64)
+        self.latest = numpy.array(latest, dtype=numpy.int64)
+        self.lengths = numpy.array(lengths, dtype=numpy.int64)
+
 class IndividualDoubles:
+    year_window = 2
+    segment_size = 10000
+    dot_size = 10000
 
     def print_doubles(self, doubles):
         for i in doubles:
             print(str(i))
-            
-    def get_doubles(self, population, identifiers, size):
-        doubles = []
-        dot_size = 10000
-        match_display_size = 100 * dot_size
+
+    def get_blocking_key(self, population, identifier):
+        name = population.get_name(identifier)
+        if name is None or len(name) == 0:
+            return None
+        return (population.get_gender(identifier), name[0].upper())
+
+    def get_blocks(self, population, identifiers):
+        blocks = {}
+        for position, i in enumerate(identifiers):
+            key = self.get_blocking_key(population, i)
+            birthday = population.get_birthday(i)
+            years = birthday.get_year_range() if birthday is not None else None
+            if key is not None and years is not None:
+                blocks.setdefault(key, []).append((years[0], years[1], position, i))
+        for block in blocks.values():
+            block.sort()
+        return blocks
+
+    def get_candidates(self, population, identifiers):
+        for block in self.get_blocks(population, identifiers).values():
+            for a in range(len(block)):
+                earliest_a, latest_a, position_a, i = block[a]
+                for b in range(a + 1, len(block)):
+                    earliest_b, latest_b, position_b, j = block[b]
+                    if earliest_b - latest_a >= self.year_window:
+                        break
+                    if position_a < position_b:
+                        yield (position_a, i), (position_b, j)
+                    else:
+                        yield (position_b, j), (position_a, i)
+
+    def get_length_bound(self, length_i, length_j):
+        # fuzz.ratio can not exceed the ratio of the shorter name to the mean length
+        return utils.intr(100 * (2.0 * min(length_i, length_j) / (length_i + length_j)))
+
+    def get_threshold(self, heap, size):
+        return heap[0][0] if 0 < size <= len(heap) else 0
+
+    def get_pruned_candidates(self, population, identifiers, heap, size):
+        generated = 0
+        for (position_i, i), (position_j, j) in self.get_candidates(population, identifiers):
+            generated += 1
+            bound = self.get_length_bound(len(population.get_name(i)), len(population.get_name(j)))
+            if bound >= self.get_threshold(heap, size):
+                yield (position_i, i), (position_j, j)
+        profiler.count("candidate_pairs_generated", generated)
+
+    def get_vectorized_candidates(self, population, identifiers, heap, size):
+        attributes = population.get_double_attributes()
+        ids = numpy.array([population.get_id(i) for i in identifiers], dtype=numpy.int64)
+        positions = numpy.arange(len(ids))
+        keys = numpy.where(ids >= 0, attributes.keys[ids], -1)
+        positions = positions[keys >= 0]
+        ids = ids[keys >= 0]
+        keys = keys[keys >= 0]
+        if len(ids) == 0:
+            return
+        earliest = attributes.earliest[ids]
+        latest = attributes.latest[ids]
+        order = numpy.lexsort((positions, latest, earliest, keys))
+        positions, keys, earliest, latest = positions[order], keys[order], earliest[order], latest[order]
+        lengths = attributes.lengths[ids[order]]
+        # Within a block sorted by earliest year, the partners of a are a contiguous run after a
+        offset = earliest.min()
+        values = (keys << 32) + (earliest - offset)
+        limits = (keys << 32) + numpy.minimum(latest - offset + self.year_window, (1 << 32) - 1)
+        counts = numpy.searchsorted(values, limits, side='left') - numpy.arange(len(values)) - 1
+        totals = numpy.cumsum(counts)
+        start = 0
+        while start < len(counts):
+            done = totals[start - 1] if start > 0 else 0
+            stop = max(start + 1, int(numpy.searchsorted(totals, done + self.segment_size, side='right')))
+            segment = counts[start:stop]
+            a = numpy.repeat(numpy.arange(start, stop), segment)
+            b = a + 1 + numpy.arange(len(a)) - numpy.repeat(numpy.cumsum(segment) - segment, segment)
+            start = stop
+            profiler.count("candidate_pairs_generated", len(a))
+            length_a = lengths[a]
+            length_b = lengths[b]
+            bounds = numpy.rint(100 * (2.0 * numpy.minimum(length_a, length_b) / (length_a + length_b)))
+            keep = bounds >= self.get_threshold(heap, size)
+            first = numpy.minimum(positions[a[keep]], positions[b[keep]])
+            second = numpy.maximum(positions[a[keep]], positions[b[keep]])
+            for position_i, position_j in zip(first.tolist(), second.tolist()):
+                yield (position_i, identifiers[position_i]), (position_j, identifiers[position_j])
+
+    def get_candidate_batches(self, population, identifiers, batch_size, heap=(), size=0):
+        if numpy is not None:
+            candidates = self.get_vectorized_candidates(population, identifiers, heap, size)
+        else:
+            candidates = self.get_pruned_candidates(population, identifiers, heap, size)
+        batch = []
+        for (position_i, i), (position_j, j) in candidates:
+            batch.append((position_i, i, population.get_name(i), position_j, j, population.get_name(j)))
+            if len(batch) == batch_size:
+                profiler.count("candidate_pairs_scored", len(batch))
+                yield batch
+                batch = []
+        if len(batch) > 0:
+            profiler.count("candidate_pairs_scored", len(batch))
+            yield batch
+
+    def add_match(self, heap, match, size):
+        if len(heap) < size:
+            heapq.heappush(heap, match)
+        elif match > heap[0]:
+            heapq.heapreplace(heap, match)
+
+    def score_candidates(self, batch, size):
+        heap = []
+        for position_i, i, name_i, position_j, j, name_j in batch:
+            score = fuzz.ratio(name_i, name_j)
+            self.add_match(heap, (score, -position_i, -position_j, i, j), size)
+        return heap
+
+    def get_scored_batches(self, pool, score, batches, window):
+        # Only a few batches per worker are queued, so the candidates are pruned with the current heap
+        pending = collections.deque()
+        for batch in batches:
+            pending.append(pool.apply_async(score, (batch,)))
+            if len(pending) >= window:
+                yield pending.popleft().get()
+        while len(pending) > 0:
+            yield pending.popleft().get()
+
+    def get_doubles(self, population, identifiers, size, jobs=1):
+        heap = []
+        dot_size = self.dot_size
+        match_display_size = 100
         count = 0
+        identifiers = list(dict.fromkeys(identifiers))
         print("Searching through " + str(len(identifiers)) + " names to find doubles." +
               " A dot printed on screen means that " + str(dot_size) +
               " name matches has been calculated...")
-        for i in identifiers:
-            for j in identifiers:
-                year_difference = population.year_difference(i, j)
-                year_difference_ok = (year_difference is not None and year_difference < 2)
-                if i != j and population.does_gender_match(i, j) and year_difference_ok:
-                    name_i = population.get_name(i)
-                    name_j = population.get_name(j)
-                    name_i_valid = name_i is not None and len(name_i) > 0
-                    name_j_valid = name_j is not None and len(name_j) > 0
-                    if name_i_valid and name_j_valid:
-                        first_letter_i = name_i[0].upper()
-                        first_letter_j = name_j[0].upper()
-                        if first_letter_i == first_letter_j:
-                            score = fuzz.ratio(name_i, name_j)
-                            if len(doubles) > 0:
-                                lowest_score, name1, id1, name2, id2, yd = doubles[-1]
-                            else:
-                                lowest_score = 0
-                            if score > lowest_score:
-                                match_exists = False
-                                for s, n1, i1, n2, i2, y in doubles:
-                                    if (i in (i1, i2)) and (j in (i1, i2)):
-                                        match_exists = True
-                                        break
-                                if not match_exists:
-                                    doubles.append((score, name_i, i, name_j, j, year_difference))
-                                    doubles.sort(key=operator.itemgetter(0), reverse=True)
-                                    doubles = doubles[0:size]
-                if (count % dot_size) == 0:
-                    sys.stdout.write('.')
-                    sys.stdout.flush()
+        batches = self.get_candidate_batches(population, identifiers, dot_size, heap, size)
+        score = functools.partial(self.score_candidates, size=size)
+        pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+        try:
+            results = self.get_scored_batches(pool, score, batches, 2 * jobs) if pool is not None else map(score, batches)
+            for local_heap in results:
+                sys.stdout.write('.')
+                sys.stdout.flush()
+                for match in local_heap:
+                    self.add_match(heap, match, size)
+                count += 1
                 if (count % match_display_size) == 0:
                     print()
-                    self.print_doubles(doubles)
-                count += 1
+                    self.print_doubles(self.sorted_doubles(population, heap))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+        print()
+        return self.sorted_doubles(population, heap)
+
+    def sorted_doubles(self, population, heap):
+        doubles = []
+        for score, position_i, position_j, i, j in sorted(heap, reverse=True):
+            doubles.append((score, population.get_name(i), i, population.get_name(j), j,
+                            population.year_difference(i, j)))
         return doubles
 
 class UnconnectedIndividuals:
-    def mark_connections(self, population, connected, identifier, direct):
-        if not connected[identifier]:
-            connected[identifier] = True
-            if direct:
-                family_members = population.get_parents(identifier)
-            else:
-                family_members = population.get_family_members(identifier)
-            for i in family_members:
-                if i is not None:
-                    self.mark_connections(population, connected, i, direct)
+    def mark_connections(self, population, connected, index, direct):
+        stack = [index]
+        while len(stack) > 0:
+            index = stack.pop()
+            if not connected[index]:
+                connected[index] = 1
+                family_members = list(population.get_parent_ids(index))
+                if not direct:
+                    family_members.extend(population.get_child_ids(index))
+                    family_members.extend(population.get_spouse_ids(index))
+                for i in family_members:
+                    if i >= 0 and not connected[i]:
+                        stack.append(i)
     def find(self, population, identifier, direct):
-        connected = dict((i, False) for i in population.get_identifiers())
-        sys.setrecursionlimit(len(connected))
-        self.mark_connections(population, connected, identifier, direct)
-        unconnected = []
-        for i in connected.keys():
-            if not connected[i]:
-                unconnected.append(i)
-        return unconnected
+        connected = bytearray(population.get_size())
+        index = population.get_id(identifier)
+        if direct and population.ancestor_index is not None:
+            for i in population.ancestor_index.get_ancestors(index, True):
+                connected[i] = 1
+        else:
+            self.mark_connections(population, connected, index, direct)
+        return population.get_identifiers_at(i for i in range(len(connected)) if not connected[i])
+
+class ConnectedComponents:
+    def __init__(self, population, direct=False):
+        self.population = population
+        size = population.get_size()
+        self.parent = array.array('i', range(size))
+        self.size = array.array('i', [1]) * size
+        for i in range(size):
+            relatives = population.get_parent_ids(i)
+            if not direct:
+                relatives = relatives + tuple(population.get_spouse_ids(i))
+            for j in relatives:
+                if j >= 0:
+                    self.union(i, j)
+        members = {}
+        for i in range(size):
+            members.setdefault(self.find(i), []).append(i)
+        self.components = sorted(members.values(), key=len, reverse=True)
+        self.component = array.array('i', [0]) * size
+        for component_id, component in enumerate(self.components):
+            for i in component:
+                self.component[i] = component_id
+
+    def find(self, index):
+        parent = self.parent
+        while parent[index] != index:
+            parent[index] = parent[parent[index]]
+            index = parent[index]
+        return index
+
+    def union(self, a, b):
+        a = self.find(a)
+        b = self.find(b)
+        if a != b:
+            if self.size[a] < self.size[b]:
+                a, b = b, a
+            self.parent[b] = a
+            self.size[a] += self.size[b]
+
+    def get_component_id(self, identifier):
+        return self.component[self.population.get_id(identifier)]
+
+    def get_components(self):
+        return [self.population.get_identifiers_at(i) for i in self.components]
+
+    def get_sizes(self):
+        return [len(i) for i in self.components]
+
+class Relationships:
+    terms = {"parent": ("father", "mother", "parent"), "child": ("son", "daughter", "child"),
+             "sibling": ("brother", "sister", "sibling"), "uncle": ("uncle", "aunt", "aunt or uncle"),
+             "nephew": ("nephew", "niece", "niece or nephew"), "spouse": ("husband", "wife", "spouse")}
+    removals = {1: "once", 2: "twice"}
+    cache_size = 1000
+
+    def __init__(self, population):
+        self.population = population
+        self.ancestor_depths = collections.OrderedDict()
+        self.neighbours = None
+
+    def get_neighbour_table(self):
+        if self.neighbours is None:
+            population = self.population
+            offsets = array.array('i', [0])
+            targets = array.array('i')
+            for index in range(population.get_size()):
+                targets.extend(i for i in population.get_parent_ids(index) if i >= 0)
+                targets.extend(population.get_child_ids(index))
+                targets.extend(population.get_spouse_ids(index))
+                offsets.append(len(targets))
+            self.neighbours = (offsets, targets)
+        return self.neighbours
+
+    def get_neighbours(self, index):
+        offsets, targets = self.get_neighbour_table()
+        return targets[offsets[index]:offsets[index + 1]]
+
+    def expand(self, frontier, visited, other):
+        offsets, targets = self.get_neighbour_table()
+        depth = visited[frontier[0]][1] + 1
+        next_frontier = []
+        meeting = None
+        for x in frontier:
+            for y in targets[offsets[x]:offsets[x + 1]]:
+                if y not in visited:
+                    visited[y] = (x, depth)
+                    next_frontier.append(y)
+                    if y in other and (meeting is None or other[y][1] < other[meeting][1]):
+                        meeting = y
+        return next_frontier, meeting
+
+    def get_path(self, source, target):
+        forward = {source: (-1, 0)}
+        backward = {target: (-1, 0)}
+        forward_frontier = [source]
+        backward_frontier = [target]
+        meeting = source if source == target else None
+        while meeting is None and len(forward_frontier) > 0 and len(backward_frontier) > 0:
+            if len(forward_frontier) <= len(backward_frontier):
+                forward_frontier, meeting = self.expand(forward_frontier, forward, backward)
+            else:
+                backward_frontier, meeting = self.expand(backward_frontier, backward, forward)
+        if meeting is None:
+            return None
+        path = []
+        x = meeting
+        while x >= 0:
+            path.append(x)
+            x = forward[x][0]
+        path.reverse()
+        x = backward[meeting][0]
+        while x >= 0:
+            path.append(x)
+            x = backward[x][0]
+        return path
+
+    def get_ancestor_depths(self, index):
+        depths = self.ancestor_depths.get(index)
+        if depths is not None:
+            self.ancestor_depths.move_to_end(index)
+        else:
+            fathers = self.population.fathers
+            mothers = self.population.mothers
+            depths = {index: 0}
+            frontier = [index]
+            depth = 0
+            while len(frontier) > 0:
+                depth += 1
+                next_frontier = []
+                for x in frontier:
+                    for parent in (fathers[x], mothers[x]):
+                        if parent >= 0 and parent not in depths:
+                            depths[parent] = depth
+                            next_frontier.append(parent)
+                frontier = next_frontier
+            self.ancestor_depths[index] = depths
+            if len(self.ancestor_depths) > self.cache_size:
+                self.ancestor_depths.popitem(last=False)
+        return depths
+
+    def get_common_ancestors(self, a, b):
+        ancestor_index = self.population.ancestor_index
+        if ancestor_index is not None and len(ancestor_index.get_common_ids(a, b)) == 0:
+            return [], None
+        depths_a = self.get_ancestor_depths(a)
+        depths_b = self.get_ancestor_depths(b)
+        if len(depths_a) > len(depths_b):
+            common = [x for x in depths_b if x in depths_a]
+        else:
+            common = [x for x in depths_a if x in depths_b]
+        if len(common) == 0:
+            return [], None
+        shortest = min(depths_a[x] + depths_b[x] for x in common)
+        best = None
+        ancestors = []
+        for x in common:
+            da = depths_a[x]
+            db = depths_b[x]
+            if da + db == shortest:
+                key = max(da, db)
+                if best is None or key < best[0]:
+                    best = (key, (da, db))
+                    ancestors = [x]
+                elif key == best[0]:
+                    ancestors.append(x)
+        return sorted(ancestors), best[1]
+
+    def get_term(self, identifier, relation):
+        terms = self.terms[relation]
+        return terms[{"M": 0, "F": 1}.get(self.population.get_gender(identifier), 2)]
+
+    def get_ordinal(self, number):
+        if 10 <= number % 100 <= 20:
+            return str(number) + "th"
+        return str(number) + {1: "st", 2: "nd", 3: "rd"}.get(number % 10, "th")
+
+    def get_greats(self, number):
+        if number == 0:
+            return ""
+        if number == 1:
+            return "great-"
+        return self.get_ordinal(number) + " great-"
+
+    def get_relationship_name(self, identifier, generations):
+        da, db = generations
+        if da == 0 and db == 0:
+            return "same person"
+        if da == 0:
+            if db == 1:
+                return self.get_term(identifier, "parent")
+            return self.get_greats(db - 2) + "grand" + self.get_term(identifier, "parent")
+        if db == 0:
+            if da == 1:
+                return self.get_term(identifier, "child")
+            return self.get_greats(da - 2) + "grand" + self.get_term(identifier, "child")
+        if da == 1 and db == 1:
+            return self.get_term(identifier, "sibling")
+        if da == 1:
+            return self.get_greats(db - 2) + self.get_term(identifier, "uncle")
+        if db == 1:
+            return self.get_greats(da - 2) + self.get_term(identifier, "nephew")
+        name = self.get_ordinal(min(da, db) - 1) + " cousin"
+        removed = abs(da - db)
+        if removed > 0:
+            name += " " + self.removals.get(removed, str(removed) + " times") + " removed"
+        return name
+
+    def get_relationship(self, a_identifier, b_identifier):
+        population = self.population
+        a = population.get_id(a_identifier)
+        b = population.get_id(b_identifier)
+        path = self.get_path(a, b) if a >= 0 and b >= 0 else None
+        relationship = {"first": a_identifier, "second": b_identifier, "relationship": None,
+                        "generations": None, "common_ancestors": [],
+                        "path": population.get_identifiers_at(path) if path is not None else []}
+        if path is None:
+            return relationship
+        ancestors, generations = self.get_common_ancestors(a, b)
+        if generations is not None:
+            relationship["relationship"] = self.get_relationship_name(a_identifier, generations)
+            relationship["generations"] = list(generations)
+            relationship["common_ancestors"] = population.get_identifiers_at(ancestors)
+        elif len(path) == 2:
+            relationship["relationship"] = self.get_term(a_identifier, "spouse")
+        else:
+            relationship["relationship"] = "related by marriage"
+        return relationship
+
+    def get_relationships(self, pairs):
+        return [self.get_relationship(a, b) for a, b in pairs]
+
+    def get_description(self, relationship):
+        population = self.population
+        first = population.get_display_name(relationship["first"])
+        second = population.get_display_name(relationship["second"])
+        steps = len(relationship["path"]) - 1
+        if relationship["relationship"] is None:
+            return first + " is not related to " + second
+        if relationship["relationship"] == "same person":
+            return first + " and " + second + " are the same person"
+        if relationship["relationship"] == "related by marriage":
+            description = first + " is related by marriage to " + second
+        else:
+            description = first + " is the " + relationship["relationship"] + " of " + second
+        return description + " (" + str(steps) + (" step)" if steps == 1 else " steps)")
+
+    def print_relationship(self, relationship, format, output_format="text"):
+        if output_format == "text":
+            print(self.get_description(relationship))
+            if len(relationship["common_ancestors"]) > 0:
+                print("Common ancestors: " + ", ".join(self.population.get_display_name(i)
+                                                       for i in relationship["common_ancestors"]))
+        self.population.print_branches([relationship["path"]] if len(relationship["path"]) > 0 else [],
+                                       format, output_format)
+
+GedcomLine = collections.namedtuple("GedcomLine", ["index", "command", "rest", "line_number"])
 
 class LineParser:
-    def __init__(self):
+    def __init__(self, chunk_size=1 << 20):
         self.line_number = 0
-        self.clear_values()
-    def clear_values(self):
-        self.command = [None, None]
-        self.rest = None
-        self.index = None
+        self.chunk_size = chunk_size
     def is_int(self, text):
         try:
             int(text)
             return True
         except ValueError:
             return False
-    def parse_next_line(self, content, valid_command):
-        self.line_number += 1
-        return self.parse_line(content, valid_command)
-    def parse_line(self, content, valid_command):
+    def read_lines(self, stream):
+        remainder = ""
+        while True:
+            chunk = stream.read(self.chunk_size)
+            if not chunk:
+                break
+            lines = (remainder + chunk).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line
+        if len(remainder) > 0:
+            yield remainder
+    def parse_words(self, words, line):
         try:
-            line = content[self.line_number]
+            rest = line.split(' ', 2)[2].strip()
         except IndexError:
-            return valid_command
-        words = line.split()
-        try:
-            index = words[0]
-        except IndexError:
-            return self.parse_next_line(content, valid_command)
-        if not valid_command:
-            if self.is_int(index):
-                self.index = int(index)
-                valid_command = True
-                self.command[0:2] = words[1:3]
-                try:
-                    self.rest = line.split(' ', 2)[2].strip()
-                except IndexError:
-                    self.rest = None
-                return self.parse_next_line(content, valid_command)
+            rest = None
+        return GedcomLine(int(words[0]), words[1:3], rest, self.line_number)
+    def _join(self, line, continuation):
+        if len(continuation) > 0:
+            line = line._replace(rest=(line.rest or "") + "".join(continuation))
+        return line
+    def tokenize(self, stream):
+        pending = None
+        continuation = []
+        for line in self.read_lines(stream):
+            self.line_number += 1
+            words = line.split()
+            if len(words) == 0:
+                continue
+            if self.is_int(words[0]):
+                if pending is not None:
+                    yield self._join(pending, continuation)
+                pending = self.parse_words(words, line)
+                continuation = []
+            elif pending is not None:
+                continuation.append(line.rstrip('\r'))
             else:
+                index = words[0]
                 print("Line " + str(self.line_number) + " does not begin with integer: '" + index + "' " + str([ord(i) for i in index]))
                 print(line)
-        elif not self.is_int(index): 
-            self.rest += line
-            self.parse_next_line(content, valid_command)
-        return valid_command
-    
-    def next_command(self, content):
-        return self.parse_line(content, False)
+        if pending is not None:
+            yield self._join(pending, continuation)
         
 class FileParser:
                     
-    def parse_file(self, content, population):
-        line_parser = LineParser()
+    def parse_file(self, stream, population):
+        with profiler.phase("parse"):
+            families = self.parse_records(stream, population)
+        with profiler.phase("link"):
+            self.link_families(families, population)
+
+    def parse_records(self, stream, population, parsers=None):
         current_parser = None
         families = {}
-        while line_parser.next_command(content):
+        records = 0
+        individuals = 0
+        for line_parser in LineParser().tokenize(stream):
             if line_parser.index == 0:
+                records += 1
                 current_parser = None
                 try:
                     identifier = line_parser.command[0]
                     if line_parser.command[1] == "INDI":
                         current_parser = Individual(identifier)
                         population.add_individual(current_parser)
+                        individuals += 1
                     elif line_parser.command[1] == "FAM":
                         current_parser = Family(identifier, population)
                         families[identifier] = current_parser
                 except IndexError:
                     pass
+                if parsers is not None:
+                    parsers.append(current_parser)
             elif current_parser is not None:
                 current_parser.parse_command(line_parser)
+        profiler.count("records", records)
+        profiler.count("individuals", individuals)
+        profiler.count("families", len(families))
+        return families
 
+    def link_families(self, families, population):
         for i in families.keys():
             family = families[i]
+            population.add_family(family)
             population.add_children(family.husbond, family.children)
             population.add_children(family.wife, family.children)
             population.add_spouse(family.husbond, family.wife)
@@ -524,36 +1687,1421 @@ class FileParser:
                 population.add_father(i, family.husbond)
                 population.add_mother(i, family.wife)
             
+class IndividualMerger:
+    xref_pattern = re.compile(r"@[^@\s]+@")
+    single_tags = {"NAME", "SEX", "BIRT", "CHR", "DEAT", "BURI"}
+
+    def __init__(self):
+        self.parent = {}
+        self.groups = None
+        self.pending = {}
+        self.merged = 0
+        self.references = 0
+
+    def find(self, identifier):
+        root = identifier
+        while self.parent.setdefault(root, root) != root:
+            root = self.parent[root]
+        while self.parent[identifier] != root:
+            self.parent[identifier], identifier = root, self.parent[identifier]
+        return root
+
+    def add_pair(self, kept, duplicate):
+        kept = self.find(kept)
+        duplicate = self.find(duplicate)
+        if kept != duplicate:
+            self.parent[duplicate] = kept
+        self.groups = None
+
+    def read_pairs(self, stream):
+        # Accepts "id1,id2" lines as well as lines copied from the doubles output
+        for line in stream:
+            identifiers = self.xref_pattern.findall(line)
+            if len(identifiers) >= 2:
+                self.add_pair(identifiers[0], identifiers[1])
+        return self
+
+    def get_groups(self):
+        if self.groups is None:
+            self.groups = {}
+            for i in list(self.parent.keys()):
+                self.groups.setdefault(self.find(i), set()).add(i)
+        return self.groups
+
+    def read_records(self, stream):
+        record = []
+        for line in LineParser().read_lines(stream):
+            if line.startswith("0 ") and len(record) > 0:
+                yield record
+                record = []
+            record.append(line)
+        if len(record) > 0:
+            yield record
+
+    def rewrite(self, line):
+        if '@' not in line:
+            return line
+        words = line.split(' ', 2)
+        if len(words) == 3 and words[0] != "0" and words[2] in self.parent:
+            canonical = self.find(words[2])
+            if canonical != words[2]:
+                self.references += 1
+                return words[0] + " " + words[1] + " " + canonical
+        return line
+
+    def get_blocks(self, record):
+        blocks = []
+        for line in record[1:]:
+            if line.startswith("1 ") or len(blocks) == 0:
+                blocks.append([line])
+            else:
+                blocks[-1].append(line)
+        return blocks
+
+    def is_pointer(self, block):
+        words = block[0].split(' ', 2)
+        return len(block) == 1 and len(words) == 3 and words[2].startswith('@')
+
+    def combine(self, header, records):
+        # Identical blocks from another record and repeated pointers are dropped,
+        # single valued tags are only taken from a duplicate when the kept record lacks them
+        tags = set()
+        seen = {}
+        lines = [header]
+        for position, record in enumerate(records):
+            record_tags = set()
+            for block in self.get_blocks(record):
+                words = block[0].split(' ', 2)
+                tag = words[1] if len(words) > 1 else None
+                key = tuple(block)
+                if key in seen and (seen[key] != position or self.is_pointer(block)):
+                    continue
+                if tag in self.single_tags and tag in tags:
+                    continue
+                record_tags.add(tag)
+                seen[key] = position
+                lines.extend(block)
+            tags.update(record_tags)
+        return lines
+
+    def add_record(self, canonical, identifier, record):
+        records = self.pending.setdefault(canonical, {})
+        records[identifier] = record
+        if len(records) < len(self.get_groups()[canonical]):
+            return None
+        return self.flush_group(canonical)
+
+    def flush_group(self, canonical):
+        records = self.pending.pop(canonical)
+        ordered = ([records.pop(canonical)] if canonical in records else []) + list(records.values())
+        header = ordered[0][0].split(' ', 2)
+        header[1] = canonical
+        self.merged += len(ordered) - 1
+        return self.combine(" ".join(header), ordered)
+
+    def write_record(self, record, output):
+        output.write("\n".join(record) + "\n")
+
+    def merge_file(self, stream, output):
+        groups = self.get_groups()
+        for record in self.read_records(stream):
+            words = record[0].split()
+            identifier = words[1] if len(words) > 1 else None
+            references = self.references
+            record = [record[0]] + [self.rewrite(i) for i in record[1:]]
+            if identifier in self.parent and len(groups[self.find(identifier)]) > 1:
+                merged = self.add_record(self.find(identifier), identifier, record)
+                if merged is not None:
+                    self.write_record(merged, output)
+                continue
+            if identifier == "TRLR":
+                for canonical in list(self.pending.keys()):
+                    self.write_record(self.flush_group(canonical), output)
+            if self.references > references:
+                record = self.combine(record[0], [record])
+            self.write_record(record, output)
+        for canonical in list(self.pending.keys()):
+            self.write_record(self.flush_group(canonical), output)
+        profiler.count("individuals_merged", self.merged)
+        profiler.count("references_rewritten", self.references)
+
+class RecordDiff:
+    record_types = {b"INDI": "individual", b"FAM": "family"}
+    plurals = {"individual": "Individuals", "family": "Families"}
+    # Change stamps are rewritten by exports without any change of the record itself
+    ignored_tags = {b"CHAN"}
+    # A line break with the white space and blank lines around it, so records compare equal across line endings
+    line_break_pattern = re.compile(rb"[ \t\x0b\x0c\r\n]*[\r\n][ \t\x0b\x0c\r\n]*")
+    unnormalized = (b"\r", b"\n\n", b" \n", b"\n ", b"\t", b"\x0b", b"\x0c")
+
+    def __init__(self, output_format="text"):
+        self.output_format = output_format
+        self.counts = dict((i, {"added": 0, "removed": 0, "modified": 0}) for i in self.record_types.values())
+
+    def get_records(self, data):
+        starts = RecordIndex().get_record_starts(data)
+        start = next(starts, None)
+        while start is not None:
+            end = next(starts, None)
+            header_end = data.find(b"\n", start, end if end is not None else len(data))
+            words = data[start:header_end if header_end >= 0 else end].split()
+            if len(words) >= 3 and words[2] in self.record_types:
+                yield words[1], self.record_types[words[2]], start, end if end is not None else len(data)
+            start = end
+
+    def is_normalized(self, data):
+        return all(data.find(i) < 0 for i in self.unnormalized)
+
+    def normalize(self, record, normalized=False):
+        # The pattern leaves the records of a file without any unnormalized line break unchanged
+        text = record.strip() if normalized else self.line_break_pattern.sub(b"\n", record).strip()
+        if not any(i in text for i in self.ignored_tags):
+            return text
+        lines = []
+        ignored_level = None
+        for line in text.split(b"\n"):
+            words = line.split(b' ', 2)
+            level = int(words[0]) if words[0].isdigit() else None
+            if ignored_level is not None:
+                if level is None or level > ignored_level:
+                    continue
+                ignored_level = None
+            if level is not None and len(words) > 1 and words[1] in self.ignored_tags:
+                ignored_level = level
+                continue
+            lines.append(line)
+        return b"\n".join(lines)
+
+    def get_digest(self, text):
+        return hashlib.blake2b(text, digest_size=16).digest()
+
+    def index_file(self, data):
+        index = {}
+        normalized = self.is_normalized(data)
+        for identifier, record_type, start, end in self.get_records(data):
+            index[identifier] = (self.get_digest(self.normalize(data[start:end], normalized)), record_type, start, end)
+        return index
+
+    def parse(self, text):
+        collector = RecordCollector()
+        families = FileParser().parse_records(io.StringIO(text.decode('utf-8', errors='replace')), collector)
+        return collector.individuals[0] if len(collector.individuals) > 0 else list(families.values())[0]
+
+    def get_fields(self, record):
+        if isinstance(record, Family):
+            return {"husband": record.husbond, "wife": record.wife, "children": record.children}
+        return {"name": record.name, "name_prefix": record.name_prefix, "married_name": record.married_name,
+                "gender": record.gender, "birthday": record.birthday.date if record.birthday is not None else None,
+                "occupation": record.occupation, "parent_family": record.parent_family,
+                "extra_parent_families": record.extra_parent_families, "families": record.families}
+
+    def get_name(self, record):
+        return record.name if isinstance(record, Individual) else None
+
+    def compare(self, old_text, new_text):
+        old_fields = self.get_fields(self.parse(old_text))
+        new_fields = self.get_fields(self.parse(new_text))
+        fields = dict((i, [old_fields[i], new_fields[i]]) for i in old_fields if old_fields[i] != new_fields[i])
+        if len(fields) == 0:
+            # Only tags that are not parsed changed, so the lines themselves are the detail
+            old_lines = old_text.split(b"\n")
+            new_lines = new_text.split(b"\n")
+            old_set = set(old_lines)
+            new_set = set(new_lines)
+            fields["lines"] = [[i.decode('utf-8', errors='replace') for i in old_lines if i not in new_set],
+                               [i.decode('utf-8', errors='replace') for i in new_lines if i not in old_set]]
+        return fields
+
+    def write_change(self, change, record_type, identifier, name, output, fields=None):
+        self.counts[record_type][change] += 1
+        identifier = identifier.decode('utf-8', errors='replace')
+        if self.output_format == "json":
+            line = {"change": change, "type": record_type, "identifier": identifier, "name": name}
+            if fields is not None:
+                line["fields"] = fields
+            output.write(json.dumps(line) + "\n")
+            return
+        output.write(change.capitalize() + " " + record_type + " " + identifier +
+                     (" " + name if name is not None else "") + "\n")
+        for field, values in (fields or {}).items():
+            if field == "lines":
+                output.writelines("    - " + i + "\n" for i in values[0])
+                output.writelines("    + " + i + "\n" for i in values[1])
+            else:
+                output.write("    " + field + ": " + str(values[0]) + " -> " + str(values[1]) + "\n")
+
+    def write_counts(self, output):
+        if self.output_format == "json":
+            output.write(json.dumps({"counts": self.counts}) + "\n")
+            return
+        for record_type, counts in self.counts.items():
+            output.write(self.plurals[record_type] + ": " + ", ".join(str(counts[i]) + " " + i for i in counts) + "\n")
+
+    def diff_data(self, old_data, new_data, output):
+        old_index = self.index_file(old_data)
+        normalized = self.is_normalized(new_data)
+        for identifier, record_type, start, end in self.get_records(new_data):
+            new_text = self.normalize(new_data[start:end], normalized)
+            old = old_index.pop(identifier, None)
+            if old is None:
+                self.write_change("added", record_type, identifier, self.get_name(self.parse(new_text)), output)
+            elif old[0] != self.get_digest(new_text):
+                old_text = self.normalize(old_data[old[2]:old[3]])
+                self.write_change("modified", record_type, identifier, self.get_name(self.parse(new_text)), output,
+                                  self.compare(old_text, new_text))
+        for identifier, (digest, record_type, start, end) in old_index.items():
+            self.write_change("removed", record_type, identifier,
+                              self.get_name(self.parse(self.normalize(old_data[start:end]))), output)
+        self.write_counts(output)
+
+    def map_file(self, f):
+        if os.fstat(f.fileno()).st_size == 0:
+            return contextlib.nullcontext(b"")
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def diff_files(self, old_filename, new_filename, output):
+        with open(old_filename, 'rb') as old_file, open(new_filename, 'rb') as new_file, \
+             self.map_file(old_file) as old_data, self.map_file(new_file) as new_data:
+            self.diff_data(old_data, new_data, output)
+        return self
+
+class PopulationCache:
+    version = 12
+
+    def __init__(self, filename, cache_directory=None, suffix=".cache", hash_content=True):
+        self.filename = os.path.abspath(filename)
+        self.cache_directory = cache_directory
+        self.suffix = suffix
+        self.hash_content = hash_content
+
+    def get_cache_filename(self):
+        if self.cache_directory is None:
+            return self.filename + self.suffix
+        key = hashlib.sha256(self.filename.encode()).hexdigest()[:16]
+        return os.path.join(self.cache_directory, os.path.basename(self.filename) + "." + key + self.suffix)
+
+    def get_content_hash(self):
+        content_hash = hashlib.sha256()
+        with open(self.filename, 'rb') as f:
+            for chunk in iter(functools.partial(f.read, 1 << 20), b''):
+                content_hash.update(chunk)
+        return content_hash.hexdigest()
+
+    def get_fingerprint(self):
+        info = os.stat(self.filename)
+        return {"version": self.version, "path": self.filename, "size": info.st_size,
+                "mtime": info.st_mtime_ns, "hash": self.get_content_hash() if self.hash_content else None}
+
+    def read(self):
+        with profiler.phase("load_cache"):
+            try:
+                with open(self.get_cache_filename(), 'rb') as f:
+                    fingerprint = pickle.load(f)
+                    if not isinstance(fingerprint, dict) or fingerprint.get("version") != self.version:
+                        return False, None
+                    # A changed file still needs the old snapshot to parse only the edited records
+                    matches = fingerprint == self.get_fingerprint()
+                    return matches, pickle.load(f)
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ImportError, TypeError):
+                return False, None
+
+    def load(self):
+        matches, data = self.read()
+        return data if matches else None
+
+    def save(self, data):
+        cache_filename = self.get_cache_filename()
+        temporary_filename = cache_filename + "." + str(os.getpid())
+        try:
+            if self.cache_directory is not None:
+                os.makedirs(self.cache_directory, exist_ok=True)
+            with open(temporary_filename, 'wb') as f:
+                pickle.dump(self.get_fingerprint(), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(data, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(temporary_filename, cache_filename)
+        except OSError as e:
+            sys.stderr.write("Unable to write cache " + cache_filename + ": " + str(e) + "\n")
+
+class RecordIndex:
+    member_pattern = re.compile(rb"\n1 (?:HUSB|WIFE|CHIL) +(@[^@\s]+@)")
+
+    def __init__(self):
+        self.records = {}
+        self.names = {}
+        self.member_families = {}
+
+    def get_record_starts(self, data):
+        start = 3 if data[:3] == codecs.BOM_UTF8 else 0
+        if data[start:start + 2] == b"0 ":
+            yield start
+        position = data.find(b"\n0 ", start)
+        while position >= 0:
+            yield position + 1
+            position = data.find(b"\n0 ", position + 1)
+
+    def build(self, filename):
+        if os.path.getsize(filename) == 0:
+            return self
+        with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            starts = list(self.get_record_starts(data))
+            starts.append(len(data))
+            for k in range(len(starts) - 1):
+                start, end = starts[k], starts[k + 1]
+                header_end = data.find(b"\n", start, end)
+                words = data[start:header_end if header_end >= 0 else end].split()
+                if len(words) < 3:
+                    continue
+                identifier = words[1].decode('utf-8', errors='replace')
+                self.records[identifier] = (start, end - start)
+                if words[2] == b"INDI":
+                    self.names[identifier] = self.get_name(data, start, end)
+                elif words[2] == b"FAM":
+                    # Families are also found from their members when the INDI record lacks FAMC or FAMS
+                    for member in self.member_pattern.findall(data, start, end):
+                        self.member_families.setdefault(member.decode('utf-8', errors='replace'), []).append(identifier)
+        return self
+
+    def get_name(self, data, start, end):
+        position = data.rfind(b"\n1 NAME ", start, end)
+        if position < 0:
+            return None
+        line_end = data.find(b"\n", position + 1, end)
+        name = data[position + 8:line_end if line_end >= 0 else end].decode('utf-8', errors='replace').strip()
+        return name.replace('/', '')
+
+    def get_identifiers(self):
+        return self.names.keys()
+
+    def get_names(self):
+        return self.names.items()
+
+    def get_record(self, identifier):
+        return self.records.get(identifier)
+
+    def get_member_families(self, identifier):
+        return self.member_families.get(identifier, [])
+
+class LazyIndividuals(dict):
+    def __init__(self, population):
+        dict.__init__(self)
+        self.population = population
+    def __missing__(self, identifier):
+        self.population.load_record(identifier)
+        return dict.__getitem__(self, identifier)
+
+class LazyPopulation(Population):
+    def __init__(self, filename, record_index):
+        Population.__init__(self)
+        self.individuals = LazyIndividuals(self)
+        self.record_index = record_index
+        self.linked = set()
+        with open(filename, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.path.getsize(filename) > 0 else b""
+
+    def load_record(self, identifier):
+        record = self.record_index.get_record(identifier)
+        if record is None:
+            raise KeyError(identifier)
+        offset, length = record
+        text = self.data[offset:offset + length].decode('utf-8', errors='replace')
+        self.families.update(FileParser().parse_records(io.StringIO(text), self))
+
+    def get_family(self, identifier):
+        if identifier not in self.families:
+            self.load_record(identifier)
+        return self.families[identifier]
+
+    def link(self, identifier):
+        if identifier in self.linked:
+            return
+        self.linked.add(identifier)
+        individual = self.get_individual(identifier)
+        families = individual.families if individual.parent_family is None else [individual.parent_family] + individual.families
+        for i in families + self.record_index.get_member_families(identifier):
+            if i in self.linked or self.record_index.get_record(i) is None:
+                continue
+            self.linked.add(i)
+            family = self.get_family(i)
+            for member in [family.husbond, family.wife] + family.children:
+                if member is not None and self.record_index.get_record(member) is not None:
+                    self.get_individual(member)
+            FileParser().link_families({i: family}, self)
+
+    def add_individual(self, individual):
+        name_index = self.name_index
+        Population.add_individual(self, individual)
+        self.name_index = name_index
+
+    def get_identifiers(self):
+        return self.record_index.get_identifiers()
+
+    def is_identifier(self, identifier):
+        return identifier in self.record_index.names
+
+    def get_name_index(self):
+        if self.name_index is None:
+            self.name_index = NameIndex(self.record_index.get_names())
+        return self.name_index
+
+    def get_children(self, identifier):
+        self.link(identifier)
+        return Population.get_children(self, identifier)
+
+    def get_father(self, identifier):
+        self.link(identifier)
+        return Population.get_father(self, identifier)
+
+    def get_mother(self, identifier):
+        self.link(identifier)
+        return Population.get_mother(self, identifier)
+
+    def get_spouses(self, identifier):
+        self.link(identifier)
+        return Population.get_spouses(self, identifier)
+
+def load_record_index(filename, cache=None, rebuild_cache=False):
+    record_index = cache.load() if cache is not None and not rebuild_cache else None
+    if record_index is None:
+        record_index = RecordIndex().build(filename)
+        if cache is not None:
+            cache.save(record_index)
+    return record_index
+
+class RecordCollector:
+    def __init__(self):
+        self.individuals = []
+    def add_individual(self, individual):
+        self.individuals.append(individual)
+
+def parse_record(record):
+    collector = RecordCollector()
+    text = record.decode('utf-8', errors='replace')
+    families = list(FileParser().parse_records(io.StringIO(text, newline=None), collector).values())
+    for i in families:
+        i.population = None
+    return collector.individuals, families
+
+def parse_record_chunk(records):
+    if len(records) > 1 and all(i.startswith(b"0 ") for i in records):
+        parsers = []
+        text = b"".join(records).decode('utf-8', errors='replace')
+        FileParser().parse_records(io.StringIO(text, newline=None), RecordCollector(), parsers)
+        # Every record starts a level-0 line, so equal counts mean one parser per record
+        if len(parsers) == len(records):
+            result = []
+            for i in parsers:
+                if isinstance(i, Family):
+                    i.population = None
+                    result.append(([], [i]))
+                elif i is not None:
+                    result.append(([i], []))
+                else:
+                    result.append(([], []))
+            return result
+    return [parse_record(i) for i in records]
+
+class IncrementalFileParser:
+    def __init__(self, snapshot=None, jobs=1, chunk_size=1000):
+        self.snapshot = snapshot if snapshot is not None else {}
+        self.jobs = jobs
+        self.chunk_size = chunk_size
+        self.records = {}
+        self.reused = 0
+        self.parsed = 0
+
+    def get_chunks(self, digests):
+        chunks = []
+        chunk = []
+        for k, digest in enumerate(digests):
+            if digest in self.records:
+                self.reused += 1
+            elif digest in self.snapshot:
+                self.records[digest] = self.snapshot[digest]
+                self.reused += 1
+            else:
+                self.records[digest] = None
+                chunk.append(k)
+                if len(chunk) == self.chunk_size:
+                    chunks.append(chunk)
+                    chunk = []
+        if len(chunk) > 0:
+            chunks.append(chunk)
+        return chunks
+
+    def parse_chunks(self, data, starts, digests, chunks):
+        tasks = ([data[starts[k]:starts[k + 1]] for k in chunk] for chunk in chunks)
+        pool = multiprocessing.Pool(self.jobs) if self.jobs > 1 and len(chunks) > 1 else None
+        try:
+            results = pool.imap(parse_record_chunk, tasks) if pool is not None else map(parse_record_chunk, tasks)
+            for chunk, result in zip(chunks, results):
+                for k, records in zip(chunk, result):
+                    self.records[digests[k]] = records
+                self.parsed += len(chunk)
+                if pool is not None:
+                    profiler.count("records", len(chunk))
+                    profiler.count("individuals", sum(len(i[0]) for i in result))
+                    profiler.count("families", sum(len(i[1]) for i in result))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def parse_file(self, filename, population):
+        families = {}
+        with profiler.phase("parse"):
+            digests = []
+            if os.path.getsize(filename) > 0:
+                with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                    starts = list(RecordIndex().get_record_starts(data))
+                    if len(starts) == 0 or starts[0] > 3:
+                        starts.insert(0, 3 if data[:3] == codecs.BOM_UTF8 else 0)
+                    starts.append(len(data))
+                    for k in range(len(starts) - 1):
+                        digests.append(hashlib.blake2b(data[starts[k]:starts[k + 1]], digest_size=16).digest())
+                    self.parse_chunks(data, starts, digests, self.get_chunks(digests))
+            for digest in digests:
+                individuals, record_families = self.records[digest]
+                for i in individuals:
+                    population.add_individual(i)
+                for i in record_families:
+                    i.population = population
+                    families[i.identifier] = i
+            profiler.count("records_reused", self.reused)
+            profiler.count("records_parsed", self.parsed)
+        with profiler.phase("link"):
+            FileParser().link_families(families, population)
+        return self.records
+
+def parse_population(filename):
+    population = Population()
+    with open(filename, 'r', errors='replace', encoding='utf-8-sig') as f:
+        FileParser().parse_file(f, population)
+    return population
+
+def load_population(filename, cache=None, rebuild_cache=False, jobs=1, ancestor_index=False):
+    if cache is None:
+        if jobs > 1:
+            population = Population()
+            IncrementalFileParser(jobs=jobs).parse_file(filename, population)
+        else:
+            population = parse_population(filename)
+        if ancestor_index:
+            population.build_ancestor_index()
+        return population
+    matches, data = (False, None) if rebuild_cache else cache.read()
+    if matches:
+        population = data[0]
+        if ancestor_index and population.ancestor_index is None:
+            population.build_ancestor_index()
+            with profiler.phase("save_cache"):
+                cache.save(data)
+        return population
+    population = Population()
+    parser = IncrementalFileParser(data[1] if data is not None else None, jobs)
+    snapshot = parser.parse_file(filename, population)
+    if ancestor_index:
+        population.build_ancestor_index()
+    with profiler.phase("save_cache"):
+        cache.save((population, snapshot))
+    return population
+
+class SqliteColumn:
+    def __init__(self, population, column):
+        self.population = population
+        self.column = column
+
+    def __getitem__(self, index):
+        row = self.population.execute("SELECT " + self.column + " FROM individuals WHERE id = ?", (index + 1,)).fetchone()
+        if row is None:
+            raise IndexError(index)
+        return row[0]
+
+    def __len__(self):
+        return self.population.get_size()
+
+    def __iter__(self):
+        for row in self.population.execute("SELECT " + self.column + " FROM individuals ORDER BY id"):
+            yield row[0]
+
+class SqliteIds:
+    def __init__(self, population):
+        self.population = population
+
+    def get(self, identifier, default=None):
+        row = self.population.execute("SELECT id - 1 FROM individuals WHERE xref = ?", (identifier,)).fetchone()
+        return row[0] if row is not None else default
+
+    def __getitem__(self, identifier):
+        index = self.get(identifier)
+        if index is None:
+            raise KeyError(identifier)
+        return index
+
+    def __contains__(self, identifier):
+        return self.get(identifier) is not None
+
+    def __len__(self):
+        return self.population.get_size()
+
+    def __iter__(self):
+        return iter(self.population.xrefs)
+
+class SqliteIndividuals:
+    cache_size = 10000
+
+    def __init__(self, population):
+        self.population = population
+        self.cache = collections.OrderedDict()
+
+    def __getitem__(self, identifier):
+        individual = self.cache.get(identifier)
+        if individual is not None:
+            self.cache.move_to_end(identifier)
+            return individual
+        row = self.population.execute("SELECT name, name_prefix, married_name, gender, birth_date, birth_earliest, "
+                                      "birth_latest, occupation, parent_family, extra_parent_families, families "
+                                      "FROM individuals WHERE xref = ?", (identifier,)).fetchone()
+        if row is None:
+            raise KeyError(identifier)
+        individual = Individual(identifier)
+        individual.name, individual.name_prefix, individual.married_name, individual.gender = row[0:4]
+        if row[4] is not None or row[5] is not None:
+            individual.birthday = Date(row[4], row[5], row[6])
+        individual.occupation = json.loads(row[7])
+        individual.parent_family = row[8]
+        individual.extra_parent_families = json.loads(row[9]) if row[9] is not None else None
+        individual.families = json.loads(row[10])
+        self.cache[identifier] = individual
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return individual
+
+    def __contains__(self, identifier):
+        return identifier in self.population.ids
+
+    def __len__(self):
+        return self.population.get_size()
+
+    def keys(self):
+        return self.population.xrefs
+
+class SqliteFamilies:
+    def __init__(self, population):
+        self.population = population
+
+    def get_family(self, identifier, husband, wife):
+        family = Family(identifier, self.population)
+        family.husbond = husband
+        family.wife = wife
+        family.children = [row[0] for row in self.population.execute(
+            "SELECT child FROM family_children WHERE family = ? ORDER BY rowid", (identifier,))]
+        return family
+
+    def __getitem__(self, identifier):
+        row = self.population.execute("SELECT husband, wife FROM families WHERE xref = ?", (identifier,)).fetchone()
+        if row is None:
+            raise KeyError(identifier)
+        return self.get_family(identifier, *row)
+
+    def __contains__(self, identifier):
+        return self.population.execute("SELECT 1 FROM families WHERE xref = ?", (identifier,)).fetchone() is not None
+
+    def __len__(self):
+        return self.population.execute("SELECT COUNT(*) FROM families").fetchone()[0]
+
+    def keys(self):
+        return [row[0] for row in self.population.execute("SELECT xref FROM families ORDER BY id")]
+
+    def values(self):
+        for row in self.population.execute("SELECT xref, husband, wife FROM families ORDER BY id"):
+            yield self.get_family(*row)
+
+class SqliteNameIndex(NameIndex):
+    def __init__(self, population):
+        self.population = population
+
+    @property
+    def names(self):
+        return [row[0] for row in self.population.execute("SELECT name FROM names ORDER BY id")]
+
+    def get_identifiers(self, name):
+        return [row[0] for row in self.population.execute(
+            "SELECT xref FROM individuals WHERE name = ? ORDER BY id", (name,))]
+
+    def get_candidates(self, name):
+        ngrams = list(self.get_ngrams(name))
+        return [row[0] for row in self.population.execute(
+            "SELECT names.name FROM (SELECT name, COUNT(*) AS count FROM name_ngrams WHERE ngram IN (" +
+            ",".join("?" * len(ngrams)) + ") GROUP BY name ORDER BY count DESC, name LIMIT ?) AS shortlist "
+            "JOIN names ON names.id = shortlist.name ORDER BY names.id", ngrams + [self.shortlist_size])]
+
+class SqlitePopulation(Population):
+    version = 2
+    batch_size = 10000
+
+    def __init__(self, database):
+        Population.__init__(self)
+        self.database = database
+        self.connection = None
+        self.pid = None
+        self.size = None
+        self.individuals = SqliteIndividuals(self)
+        self.families = SqliteFamilies(self)
+        self.ids = SqliteIds(self)
+        self.xrefs = SqliteColumn(self, "xref")
+        self.fathers = SqliteColumn(self, "COALESCE(father, 0) - 1")
+        self.mothers = SqliteColumn(self, "COALESCE(mother, 0) - 1")
+
+    def get_connection(self):
+        # A connection must not be shared with forked worker processes
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = sqlite3.connect(self.database)
+            self.pid = os.getpid()
+        return self.connection
+
+    def execute(self, sql, parameters=()):
+        return self.get_connection().execute(sql, parameters)
+
+    def get_fingerprint(self, filename):
+        fingerprint = PopulationCache(filename).get_fingerprint()
+        fingerprint["version"] = self.version
+        return json.dumps(fingerprint, sort_keys=True)
+
+    def get_stored_fingerprint(self):
+        try:
+            row = self.execute("SELECT value FROM meta WHERE key = 'fingerprint'").fetchone()
+        except sqlite3.DatabaseError:
+            return None
+        return row[0] if row is not None else ""
+
+    def is_loaded(self, filename):
+        return self.get_stored_fingerprint() == self.get_fingerprint(filename)
+
+    def create_tables(self):
+        connection = self.get_connection()
+        connection.executescript("""
+            PRAGMA journal_mode = OFF;
+            PRAGMA synchronous = OFF;
+            CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+            CREATE TABLE individuals (id INTEGER PRIMARY KEY, xref TEXT UNIQUE NOT NULL, name TEXT,
+                name_prefix TEXT, married_name TEXT, gender TEXT, birth_date TEXT, birth_earliest INTEGER,
+                birth_latest INTEGER, birth_year_earliest INTEGER, birth_year_latest INTEGER, occupation TEXT,
+                parent_family TEXT, extra_parent_families TEXT, families TEXT, father INTEGER, mother INTEGER);
+            CREATE TABLE families (id INTEGER PRIMARY KEY, xref TEXT UNIQUE NOT NULL, husband TEXT, wife TEXT);
+            CREATE TABLE family_children (family TEXT NOT NULL, child TEXT NOT NULL);
+            CREATE INDEX family_children_family ON family_children (family);
+            CREATE TABLE children (parent INTEGER NOT NULL, child INTEGER NOT NULL);
+            CREATE TABLE spouses (individual INTEGER NOT NULL, spouse INTEGER NOT NULL);
+            CREATE TABLE names (id INTEGER PRIMARY KEY, name TEXT NOT NULL);
+            CREATE TABLE name_ngrams (ngram TEXT NOT NULL, name INTEGER NOT NULL);
+        """)
+
+    def get_individual_row(self, individual):
+        birthday = individual.birthday
+        years = birthday.get_year_range() if birthday is not None else None
+        return (individual.identifier, individual.name, individual.name_prefix, individual.married_name,
+                individual.gender, birthday.date if birthday is not None else None,
+                birthday.earliest if birthday is not None else None, birthday.latest if birthday is not None else None,
+                years[0] if years is not None else None, years[1] if years is not None else None,
+                json.dumps(individual.occupation), individual.parent_family,
+                json.dumps(individual.extra_parent_families) if individual.extra_parent_families is not None else None,
+                json.dumps(individual.families))
+
+    def insert_records(self, result):
+        individuals = [self.get_individual_row(i) for individuals, families in result for i in individuals]
+        families = [i for individuals, families in result for i in families]
+        with self.get_connection() as connection:
+            # Like Population, a repeated xref keeps its first position and the values of its last record
+            connection.executemany(
+                "INSERT INTO individuals (xref, name, name_prefix, married_name, gender, birth_date, birth_earliest, "
+                "birth_latest, birth_year_earliest, birth_year_latest, occupation, parent_family, "
+                "extra_parent_families, families) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (xref) DO UPDATE SET name = excluded.name, name_prefix = excluded.name_prefix, "
+                "married_name = excluded.married_name, gender = excluded.gender, birth_date = excluded.birth_date, "
+                "birth_earliest = excluded.birth_earliest, birth_latest = excluded.birth_latest, "
+                "birth_year_earliest = excluded.birth_year_earliest, birth_year_latest = excluded.birth_year_latest, "
+                "occupation = excluded.occupation, parent_family = excluded.parent_family, "
+                "extra_parent_families = excluded.extra_parent_families, families = excluded.families", individuals)
+            connection.executemany(
+                "INSERT INTO families (xref, husband, wife) VALUES (?, ?, ?) ON CONFLICT (xref) DO UPDATE SET "
+                "husband = excluded.husband, wife = excluded.wife", ((i.identifier, i.husbond, i.wife) for i in families))
+            connection.executemany("DELETE FROM family_children WHERE family = ?", ((i.identifier,) for i in families))
+            connection.executemany("INSERT INTO family_children (family, child) VALUES (?, ?)",
+                                   ((i.identifier, child) for i in families for child in i.children))
+
+    def get_record_chunks(self, data):
+        start = 3 if data[:3] == codecs.BOM_UTF8 else 0
+        chunk = []
+        for end in RecordIndex().get_record_starts(data):
+            if end > start:
+                chunk.append(data[start:end])
+                if len(chunk) == self.batch_size:
+                    yield chunk
+                    chunk = []
+            start = end
+        if len(data) > start:
+            chunk.append(data[start:])
+        if len(chunk) > 0:
+            yield chunk
+
+    def parse_file(self, filename, jobs=1):
+        if os.path.getsize(filename) == 0:
+            return
+        pool = multiprocessing.Pool(jobs) if jobs > 1 else None
+        try:
+            with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                chunks = self.get_record_chunks(data)
+                while True:
+                    # Only a few chunks per worker are read ahead, so memory stays bounded
+                    window = [chunk for k, chunk in zip(range(max(1, 2 * jobs)), chunks)]
+                    if len(window) == 0:
+                        break
+                    results = pool.imap(parse_record_chunk, window) if pool is not None else map(parse_record_chunk, window)
+                    for result in results:
+                        self.insert_records(result)
+                        # Chunks parsed in this process were already counted by the parser
+                        if pool is not None:
+                            profiler.count("records", len(result))
+                            profiler.count("individuals", sum(len(i[0]) for i in result))
+                            profiler.count("families", sum(len(i[1]) for i in result))
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+    def link(self):
+        with self.get_connection() as connection:
+            connection.executescript("""
+                CREATE INDEX family_children_child ON family_children (child);
+                UPDATE individuals SET (father, mother) = (
+                    SELECT husband.id, wife.id FROM family_children
+                    JOIN families ON families.xref = family_children.family
+                    LEFT JOIN individuals AS husband ON husband.xref = families.husband
+                    LEFT JOIN individuals AS wife ON wife.xref = families.wife
+                    WHERE family_children.child = individuals.xref ORDER BY families.id DESC LIMIT 1);
+                INSERT INTO children (parent, child)
+                    SELECT parent.id, child.id FROM
+                        (SELECT id, 0 AS role, husband AS xref FROM families
+                         UNION ALL SELECT id, 1, wife FROM families) AS members
+                    JOIN families ON families.id = members.id
+                    JOIN family_children ON family_children.family = families.xref
+                    JOIN individuals AS parent ON parent.xref = members.xref
+                    JOIN individuals AS child ON child.xref = family_children.child
+                    ORDER BY members.id, members.role, family_children.rowid;
+                INSERT INTO spouses (individual, spouse)
+                    SELECT first.id, second.id FROM
+                        (SELECT id, 0 AS role, husband AS first, wife AS second FROM families
+                         UNION ALL SELECT id, 1, wife, husband FROM families) AS members
+                    JOIN individuals AS first ON first.xref = members.first
+                    JOIN individuals AS second ON second.xref = members.second
+                    ORDER BY members.id, members.role;
+                CREATE INDEX individuals_name ON individuals (name);
+                CREATE INDEX individuals_birth_year ON individuals (birth_year_earliest, birth_year_latest);
+                CREATE INDEX individuals_father ON individuals (father);
+                CREATE INDEX individuals_mother ON individuals (mother);
+                CREATE INDEX children_parent ON children (parent);
+                CREATE INDEX spouses_individual ON spouses (individual);
+                INSERT INTO names (name) SELECT name FROM individuals WHERE name IS NOT NULL
+                    GROUP BY name ORDER BY MIN(id);
+            """)
+
+    def index_names(self):
+        name_index = SqliteNameIndex(self)
+        cursor = self.get_connection().cursor()
+        cursor.execute("SELECT id, name FROM names ORDER BY id")
+        while True:
+            rows = cursor.fetchmany(self.batch_size)
+            if len(rows) == 0:
+                break
+            with self.get_connection() as connection:
+                connection.executemany("INSERT INTO name_ngrams (ngram, name) VALUES (?, ?)",
+                                       ((ngram, i) for i, name in rows for ngram in name_index.get_ngrams(name)))
+        with self.get_connection() as connection:
+            connection.execute("CREATE INDEX name_ngrams_ngram ON name_ngrams (ngram, name)")
+
+    def load(self, filename, jobs=1):
+        if os.path.exists(self.database):
+            # Never replace a file that was not written by load, e.g. a GEDCOM file given by mistake
+            if os.path.getsize(self.database) > 0 and self.get_stored_fingerprint() is None:
+                raise ValueError(self.database + " is not a population database")
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+            os.remove(self.database)
+        self.create_tables()
+        with profiler.phase("parse"):
+            self.parse_file(filename, jobs)
+        with profiler.phase("link"):
+            self.link()
+            self.index_names()
+        with self.get_connection() as connection:
+            connection.execute("INSERT INTO meta (key, value) VALUES ('fingerprint', ?)", (self.get_fingerprint(filename),))
+        self.size = None
+        return self
+
+    def get_size(self):
+        if self.size is None:
+            self.size = self.execute("SELECT COUNT(*) FROM individuals").fetchone()[0]
+        return self.size
+
+    def get_attribute_rows(self):
+        for name, gender, earliest, latest in self.execute(
+                "SELECT name, gender, birth_year_earliest, birth_year_latest FROM individuals ORDER BY id"):
+            yield name, gender, (earliest, latest) if earliest is not None else None
+
+    def get_name_index(self):
+        if self.name_index is None:
+            self.name_index = SqliteNameIndex(self)
+        return self.name_index
+
+    def get_identifier_at(self, index):
+        return self.xrefs[index] if index >= 0 else None
+
+    def get_identifiers_at(self, indexes):
+        indexes = list(indexes)
+        xrefs = {}
+        for k in range(0, len(indexes), 500):
+            batch = [i + 1 for i in indexes[k:k + 500]]
+            xrefs.update(self.execute("SELECT id - 1, xref FROM individuals WHERE id IN (" +
+                                      ",".join("?" * len(batch)) + ")", batch))
+        return [xrefs[i] for i in indexes]
+
+    def get_child_ids(self, index):
+        return [row[0] for row in self.execute("SELECT child - 1 FROM children WHERE parent = ? ORDER BY rowid", (index + 1,))]
+
+    def get_spouse_ids(self, index):
+        return [row[0] for row in self.execute(
+            "SELECT spouse - 1 FROM spouses WHERE individual = ? ORDER BY rowid", (index + 1,))]
+
+    def get_parent_ids(self, index):
+        return self.execute("SELECT COALESCE(father, 0) - 1, COALESCE(mother, 0) - 1 FROM individuals WHERE id = ?",
+                            (index + 1,)).fetchone()
+
+    def is_identifier(self, identifier):
+        return identifier in self.ids
+
+    def get_children(self, identifier):
+        return [row[0] for row in self.execute(
+            "SELECT child.xref FROM individuals AS parent JOIN children ON children.parent = parent.id "
+            "JOIN individuals AS child ON child.id = children.child WHERE parent.xref = ? ORDER BY children.rowid",
+            (identifier,))]
+
+    def get_spouses(self, identifier):
+        return [row[0] for row in self.execute(
+            "SELECT spouse.xref FROM individuals AS individual JOIN spouses ON spouses.individual = individual.id "
+            "JOIN individuals AS spouse ON spouse.id = spouses.spouse WHERE individual.xref = ? ORDER BY spouses.rowid",
+            (identifier,))]
+
+    def get_parent(self, identifier, column):
+        row = self.execute("SELECT parent.xref FROM individuals AS individual JOIN individuals AS parent "
+                           "ON parent.id = individual." + column + " WHERE individual.xref = ?", (identifier,)).fetchone()
+        return row[0] if row is not None else None
+
+    def get_father(self, identifier):
+        return self.get_parent(identifier, "father")
+
+    def get_mother(self, identifier):
+        return self.get_parent(identifier, "mother")
+
+def load_sqlite_population(filename, database, rebuild=False, jobs=1):
+    population = SqlitePopulation(database)
+    if rebuild or not os.path.exists(database) or not population.is_loaded(filename):
+        with profiler.phase("load_sqlite"):
+            population.load(filename, jobs)
+    return population
+
+class QueryServer:
+    def __init__(self, filename, cache=None, jobs=1, ancestor_index=False):
+        self.filename = filename
+        self.cache = cache
+        self.jobs = jobs
+        self.ancestor_index = ancestor_index
+        self.population = None
+        self.mtime = None
+
+    def get_population(self):
+        mtime = os.stat(self.filename).st_mtime_ns
+        if self.population is None or mtime != self.mtime:
+            self.population = load_population(self.filename, self.cache, jobs=self.jobs, ancestor_index=self.ancestor_index)
+            self.mtime = mtime
+        return self.population
+
+    def get_person(self, population, identifier):
+        if identifier is None:
+            return None
+        return {"identifier": identifier, "name": population.get_name(identifier)}
+
+    def get_people(self, population, identifiers):
+        return [self.get_person(population, i) for i in identifiers]
+
+    def get_identifiers(self, population, request):
+        names = request.get("names")
+        if names is None:
+            return None
+        matched_names, tree = population.match_branches(names)
+        return list(dict.fromkeys(i for branch in tree for i in branch))
+
+    def query_person(self, population, request):
+        identifier = population.resolve_identifier(request["names"][0])
+        result = self.get_person(population, identifier)
+        result["gender"] = population.get_gender(identifier)
+        result["birthday"] = population.default_when_none(population.get_birthday(identifier), None)
+        result["father"] = self.get_person(population, population.get_father(identifier))
+        result["mother"] = self.get_person(population, population.get_mother(identifier))
+        result["spouses"] = self.get_people(population, population.get_spouses(identifier))
+        result["children"] = self.get_people(population, population.get_children(identifier))
+        return result
+
+    def query_branches(self, population, request):
+        matched_names, tree = population.match_branches(request["names"])
+        return {"matched_names": matched_names,
+                "branches": [self.get_people(population, branch) for branch in tree]}
+
+    def query_longest_branch(self, population, request):
+        identifier = population.resolve_identifier(request["names"][0])
+        return self.get_people(population, population.find_longest_branch(identifier))
+
+    def query_unconnected(self, population, request):
+        identifier = population.resolve_identifier(request["names"][0])
+        unconnected = UnconnectedIndividuals().find(population, identifier, request.get("direct", False))
+        return self.get_people(population, unconnected)
+
+    def query_doubles(self, population, request):
+        identifiers = self.get_identifiers(population, request)
+        if identifiers is None:
+            identifiers = population.get_identifiers()
+        doubles = IndividualDoubles().get_doubles(population, identifiers, request.get("size", 10), request.get("jobs", 1))
+        return [{"score": score, "first": self.get_person(population, i), "second": self.get_person(population, j),
+                 "year_difference": year_difference}
+                for score, name_i, i, name_j, j, year_difference in doubles]
+
+    def query_relationship(self, population, request):
+        relationships = Relationships(population)
+        pairs = request.get("pairs", [request.get("names")])
+        result = []
+        for first, second in pairs:
+            relationship = relationships.get_relationship(population.resolve_identifier(first),
+                                                          population.resolve_identifier(second))
+            relationship["first"] = self.get_person(population, relationship["first"])
+            relationship["second"] = self.get_person(population, relationship["second"])
+            relationship["common_ancestors"] = self.get_people(population, relationship["common_ancestors"])
+            relationship["path"] = self.get_people(population, relationship["path"])
+            result.append(relationship)
+        return result if "pairs" in request else result[0]
+
+    def query_validate(self, population, request):
+        validator = PopulationValidator(request.get("jobs", 1))
+        options = request.get("options", ["gender", "occupation"])
+        findings = validator.get_findings(population, options, self.get_identifiers(population, request))
+        return {"findings": validator.to_dicts(population, findings), "counts": validator.get_counts(options, findings)}
+
+    def handle(self, request):
+        response = {"id": request.get("id")}
+        handler = getattr(self, "query_" + str(request.get("operation")), None)
+        if handler is None:
+            response["error"] = "Unknown operation: " + str(request.get("operation"))
+            return response
+        try:
+            population = self.get_population()
+            with contextlib.redirect_stdout(io.StringIO()):
+                response["result"] = handler(population, request)
+        except (KeyError, IndexError, TypeError, ValueError, OSError) as e:
+            response["error"] = type(e).__name__ + ": " + str(e)
+        return response
+
+    def serve_stream(self, input_stream, output_stream):
+        for line in input_stream:
+            if len(line.strip()) == 0:
+                continue
+            try:
+                request = json.loads(line)
+                if isinstance(request, dict):
+                    response = self.handle(request)
+                else:
+                    response = {"id": None, "error": "Invalid request"}
+            except ValueError as e:
+                response = {"id": None, "error": "Invalid request: " + str(e)}
+            output_stream.write(json.dumps(response) + "\n")
+            output_stream.flush()
+
+    def serve_socket(self, path):
+        server = self
+        class Handler(socketserver.StreamRequestHandler):
+            def handle(self):
+                output = io.TextIOWrapper(self.wfile, encoding='utf-8', write_through=True)
+                server.serve_stream(io.TextIOWrapper(self.rfile, encoding='utf-8'), output)
+                output.detach()
+        if os.path.exists(path):
+            if not stat.S_ISSOCK(os.stat(path).st_mode):
+                raise ValueError("Not a socket, refusing to replace " + path)
+            os.remove(path)
+        with socketserver.UnixStreamServer(path, Handler) as unix_server:
+            try:
+                unix_server.serve_forever()
+            finally:
+                os.remove(path)
+
+def run_batch_query(query):
+    return QueryBatch().run(QueryBatch.worker_population, query)
+
+def set_batch_population(population):
+    QueryBatch.worker_population = population
+
+class InvalidQuery(dict):
+    pass
+
+class QueryBatch:
+    formats = ("text", "dot", "json", "graphml", "csv")
+
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+
+    def get_arguments(self, query):
+        names = query.get("names")
+        if isinstance(names, str):
+            names = names.split(',')
+        output_format = query.get("output_format", "text")
+        if output_format not in self.formats:
+            raise ValueError("Unknown output format: " + str(output_format))
+        validation_options = query.get("validate")
+        if isinstance(validation_options, str):
+            validation_options = validation_options.split(',')
+        if validation_options is not None:
+            PopulationValidator().get_rule_names(validation_options)
+        direct = query.get("direct", False)
+        # Queries already run in worker processes, which may not start pools of their own
+        return {"names": names, "format": query.get("format", "%n"), "output_format": output_format,
+                "show_unconnected": query.get("unconnected", False) or direct, "direct": direct,
+                "show_longest_branch": query.get("longest_branch", False),
+                "show_relationship": query.get("relationship", False),
+                "show_components": query.get("components", False),
+                "number_of_doubles": query.get("doubles"), "validation_options": validation_options, "jobs": 1}
+
+    def run(self, population, query):
+        if isinstance(query, InvalidQuery):
+            return dict(query)
+        response = {"id": query.get("id")}
+        try:
+            arguments = self.get_arguments(query)
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                run_query(population, **arguments)
+            if "output" in query:
+                with open(query["output"], 'w') as f:
+                    f.write(output.getvalue())
+                response["output"] = query["output"]
+            else:
+                response["result"] = output.getvalue()
+        except (KeyError, IndexError, TypeError, ValueError, OSError) as e:
+            response["error"] = type(e).__name__ + ": " + str(e)
+        return response
+
+    def read_queries(self, stream):
+        queries = []
+        for number, line in enumerate(stream):
+            if len(line.strip()) == 0:
+                continue
+            try:
+                query = json.loads(line)
+            except ValueError as e:
+                query = InvalidQuery(id=number + 1, error="Invalid query: " + str(e))
+            if not isinstance(query, dict):
+                query = InvalidQuery(id=number + 1, error="Invalid query")
+            query.setdefault("id", number + 1)
+            queries.append(query)
+        return queries
+
+    def run_queries(self, population, queries, output_stream):
+        pool = None
+        if self.jobs > 1 and len(queries) > 1:
+            pool = multiprocessing.Pool(self.jobs, set_batch_population, (population,))
+        try:
+            if pool is not None:
+                responses = pool.imap(run_batch_query, queries)
+            else:
+                responses = map(functools.partial(self.run, population), queries)
+            for response in responses:
+                output_stream.write(json.dumps(response) + "\n")
+                output_stream.flush()
+        finally:
+            if pool is not None:
+                pool.close()
+                pool.join()
+
+def merge_gedcom(inputfile, pairs_file, outputfile):
+    with open(pairs_file, 'r', encoding='utf-8-sig') as f:
+        merger = IndividualMerger().read_pairs(f)
+    with open(inputfile, 'r', errors='replace', encoding='utf-8-sig') as f, open(outputfile, 'w', encoding='utf-8') as output:
+        merger.merge_file(f, output)
+    return merger
+
+def read_name_pairs(filename):
+    with open(filename, 'r', encoding='utf-8-sig') as f:
+        for line in f:
+            names = [i.strip() for i in line.split(',')]
+            if len(names) == 2 and len(names[0]) > 0 and len(names[1]) > 0:
+                yield names
+
+def print_relationships(population, filename, output_format="text"):
+    relationships = Relationships(population)
+    identifiers = {}
+    for names in read_name_pairs(filename):
+        for i in names:
+            if i not in identifiers:
+                identifiers[i] = population.resolve_identifier(i)
+        relationship = relationships.get_relationship(identifiers[names[0]], identifiers[names[1]])
+        if output_format == "json":
+            print(json.dumps(relationship))
+        else:
+            print(relationships.get_description(relationship))
+
+def run_query(population, names=None, format="%n", output_format="text", show_unconnected=False, direct=False,
+              show_longest_branch=False, show_relationship=False, show_components=False, number_of_doubles=None,
+              validation_options=None, jobs=1):
+    # csv only applies to validation findings, branches are then shown as text
+    branch_format = "text" if output_format == "csv" else output_format
+    if names is not None:
+        if len(names) > 1 and show_relationship:
+            with profiler.phase("match_names"):
+                identifiers = [population.resolve_identifier(i) for i in names[:2]]
+            with profiler.phase("relationship"):
+                relationships = Relationships(population)
+                relationships.print_relationship(relationships.get_relationship(*identifiers), format, branch_format)
+        elif len(names) > 1:
+            with profiler.phase("match_names"):
+                matched_names, tree = population.match_branches(names)
+            if branch_format == "text":
+                print("The names " + str(names) + " matched the names " + str(matched_names))
+            with profiler.phase("output"):
+                population.print_branches(tree, format, branch_format)
+            identifiers = [i for sublist in tree for i in sublist]
+            unique_identifiers = list(dict.fromkeys(identifiers))
+            if number_of_doubles is not None:
+                with profiler.phase("doubles"):
+                    individual_doubles = IndividualDoubles()
+                    doubles = individual_doubles.get_doubles(population, unique_identifiers, number_of_doubles, jobs)
+                    individual_doubles.print_doubles(doubles)
+            if validation_options is not None:
+                with profiler.phase("validate"):
+                    PopulationValidator(jobs).validate(population, validation_options, unique_identifiers, output_format)
+        else:
+            with profiler.phase("match_names"):
+                identifier = population.resolve_identifier(names[0])
+            name = population.default_when_none(population.get_name(identifier))
+            print("Name = " + name)
+            population.print_identifier(identifier)
+            if show_unconnected:
+                with profiler.phase("unconnected"):
+                    unconnected = UnconnectedIndividuals().find(population, identifier, direct)
+                    print("Unconnected with " + name + ":")
+                    for i in unconnected:
+                        print(population.get_display_name(i))
+                    print("Found " + str(len(unconnected)) + " unconnected individuals")
+            if show_longest_branch:
+                with profiler.phase("longest_branch"):
+                    longest_branch = population.find_longest_branch(identifier)
+                    for i in longest_branch:
+                        print(population.apply_format(i, format))
+    elif show_components:
+        with profiler.phase("components"):
+            components = ConnectedComponents(population, direct).get_components()
+            print("Found " + str(len(components)) + " connected components")
+            for component_id, component in enumerate(components):
+                print("# Component " + str(component_id + 1) + ": " + str(len(component)) + " individuals")
+                if component_id > 0:
+                    for i in component:
+                        print(population.get_display_name(i))
+    elif number_of_doubles is not None:
+        with profiler.phase("doubles"):
+            i = IndividualDoubles()
+            identifiers = population.get_identifiers()
+            doubles = i.get_doubles(population, identifiers, number_of_doubles, jobs)
+            i.print_doubles(doubles)
+    elif validation_options is not None:
+        with profiler.phase("validate"):
+            PopulationValidator(jobs).validate(population, validation_options, output_format=output_format)
+
+
 def usage():
     print('gedcom_path.py -f <filename> -n <list> -d <number> -x <format> -u -x <format>')
     print('-f <name>   GEDCOM file name')
     print('-n <list>   Show branch containing all names in list')
     print('-u          Show unconnected individuals of branch specified by -n parameter')
     print('-v          Show individuals not directly connected to individual specified by -n parameter')
+    print('-c          Show connected components of the whole population, listing all but the largest')
+    print('            (with -v only parent/child relations connect individuals)')
     print('-l          Show longest branch of individual specified by -n parameter')
+    print('-r          Show relationship and shortest path between the two individuals specified by -n parameter')
     print('-d <number> Show <number> of doubles')
+    print('-j <number> Number of worker processes used to parse the file and by -d (default: 1)')
     print('-o <format> Output format (default: stdout)')
-    print('            dot : Dot format displayed by Graphviz')
-    print('-e <list>   Validate (list = gender,occupation)')
+    print('            dot     : Dot format displayed by Graphviz')
+    print('            json    : Branches as lists of identifiers with a label per individual')
+    print('            graphml : GraphML graph of the branches')
+    print('            csv     : Validation findings as comma separated values')
+    print('-e <list>   Validate (list = all or ' + ','.join(PopulationValidator.rules.keys()) + ')')
     print('-x <format> Show output in <format> (default = %n)')
     print('            %n : Name')
     print('            %g : Gender')
     print('            %b : Birthday')
     print('            %o : Occupation')
     print('            %p : Name prefix')
+    print('--cache-dir <dir> Store parsed population cache in <dir> (default: next to GEDCOM file)')
+    print('                  The cache is a pickle file, loading a tampered cache runs arbitrary code,')
+    print('                  so only use --cache-dir and GEDCOM directories that others cannot write to')
+    print('--no-cache        Do not read or write the parsed population cache')
+    print('--rebuild-cache   Parse the GEDCOM file and overwrite the cache')
+    print('--sqlite <file>   Load the population into SQLite database <file>, reused until the GEDCOM file changes,')
+    print('                  and run the analyses from it to keep memory bounded on very large files')
+    print('--ancestor-index  Precompute the ancestors of every individual to speed up branch searches and -v,')
+    print('                  stored in the cache (memory grows with the total number of ancestors of all individuals)')
+    print('--profile         Report time and peak RSS of the process after each phase and counters on stderr,')
+    print('                  nested phases are indented and included in the time of the phase above them')
+    print('--profile-file <file> Write the --profile report as JSON to <file>')
+    print('--merge <file>    Merge the duplicate pairs in <file> (two xrefs per line, e.g. doubles output lines)')
+    print('                  and write the merged GEDCOM file to --ofile <file>')
+    print('--batch <file>    Run the JSON line queries in <file> against one parse, -j queries at a time, and')
+    print('                  write a JSON line per query in input order, e.g.')
+    print('                  {"names": ["name1", "name2"], "format": "%n %b", "output_format": "json", "output": "file"}')
+    print('                  keys: names, format, output_format, unconnected, direct, longest_branch, relationship,')
+    print('                  components, doubles, validate, output (write the result to a file)')
+    print('--diff <old> [<new>] Show individuals and families added, removed or modified in <new> (or the -f file)')
+    print('                  compared with <old>, with the changed fields of modified records (-o json for JSON lines)')
+    print('--relationships <file> Show relationship of each pair of names in <file> (one "name1,name2" per line)')
+    print('--serve           Answer JSON line requests on stdin, reloading when the file changes')
+    print('--socket <path>   Answer JSON line requests on a Unix socket')
+    print('                  {"id": 1, "operation": "person", "names": ["name"]}')
+    print('                  operations: person, branches, longest_branch, unconnected, doubles, validate, relationship')
     
 def main(argv):
     inputfile = None
     names = None
     number_of_doubles = None
     show_unconnected = False
+    show_components = False
     show_longest_branch = None
+    show_relationship = False
+    relationship_file = None
+    merge_file = None
+    batch_file = None
+    sqlite_file = None
+    diff_file = None
+    outputfile = None
     direct = False
     validation_options = None
-    dot_format = False
+    output_format = "text"
     format = "%n"
+    jobs = 1
+    use_cache = True
+    rebuild_cache = False
+    cache_directory = None
+    serve = False
+    socket_path = None
+    profile = False
+    profile_file = None
+    ancestor_index = False
     try:
-        opts, args = getopt.getopt(argv,"hd:e:f:ln:o:x:uv",["ifile=","ofile="])
+        opts, args = getopt.gnu_getopt(argv,"hcd:e:f:j:ln:o:rx:uv",["ifile=","ofile=","cache-dir=","no-cache","rebuild-cache","serve","socket=","profile","profile-file=","relationships=","merge=","batch=","sqlite=","diff=","ancestor-index"])
     except getopt.GetoptError:
         usage()
         sys.exit(2)
@@ -567,87 +3115,150 @@ def main(argv):
             names = arg.split(',')
         elif opt == "-d":
             number_of_doubles = int(arg)
+        elif opt == "-j":
+            jobs = int(arg)
         elif opt == "-u":
             show_unconnected = True
+        elif opt == "-c":
+            show_components = True
         elif opt == "-l":
             show_longest_branch = True
+        elif opt == "-r":
+            show_relationship = True
+        elif opt == "--relationships":
+            relationship_file = arg
+        elif opt == "--merge":
+            merge_file = arg
+        elif opt == "--batch":
+            batch_file = arg
+        elif opt == "--sqlite":
+            sqlite_file = arg
+        elif opt == "--diff":
+            diff_file = arg
+        elif opt == "--ofile":
+            outputfile = arg
         elif opt == "-v":
             show_unconnected = True
             direct = True
         elif opt == "-e":
             validation_options = arg.split(',')
         elif opt == "-o":
-            dot_format = (arg == "dot")
+            # stdout names the default text output, as in the usage text
+            output_format = "text" if arg == "stdout" else arg
         elif opt == "-x":
             format = arg
+        elif opt == "--cache-dir":
+            cache_directory = arg
+        elif opt == "--no-cache":
+            use_cache = False
+        elif opt == "--rebuild-cache":
+            rebuild_cache = True
+        elif opt == "--serve":
+            serve = True
+        elif opt == "--socket":
+            socket_path = arg
+        elif opt == "--profile":
+            profile = True
+        elif opt == "--profile-file":
+            profile_file = arg
+        elif opt == "--ancestor-index":
+            ancestor_index = True
+
+    if diff_file is not None and len(args) > 0:
+        inputfile = args[0]
+        args = args[1:]
+
+    if len(args) > 0:
+        print("Unexpected arguments: " + " ".join(args))
+        usage()
+        sys.exit(2)
+
+    if output_format not in ("text", "dot", "json", "graphml", "csv"):
+        print("Unknown output format: " + output_format)
+        usage()
+        sys.exit(2)
+
+    if validation_options is not None:
+        try:
+            PopulationValidator().get_rule_names(validation_options)
+        except ValueError as e:
+            print(str(e))
+            usage()
+            sys.exit(2)
 
     if inputfile is None:
         print("Input file missing")
         usage()
         sys.exit(2)
 
-    with open(inputfile, 'r', errors='replace', encoding='utf-8-sig') as f:
-        content = f.readlines()
+    if merge_file is not None and outputfile is None:
+        print("Output file missing")
+        usage()
+        sys.exit(2)
 
-    population = Population()
-    file_parser = FileParser()
-    file_parser.parse_file(content, population)
-    
-    if names is not None:
-        if len(names) > 1:
-            matched_names = [population.find_closest_match(i) for i in names]
-            if not dot_format:
-                print("The names " + str(names) + " matched the names " + str(matched_names))
-            descendent_name = matched_names[0]
-            ancester_name = matched_names[-1]
-            contains_names = matched_names[1:-1]
-            tree = population.get_branches(ancester_name, descendent_name, contains_names)
-            population.print_branches(tree, format, dot_format)
-            identifiers = [i for sublist in tree for i in sublist]
-            unique_identifiers = list(dict.fromkeys(identifiers))
-            if number_of_doubles is not None:
-                individual_doubles = IndividualDoubles()
-                doubles = individual_doubles.get_doubles(population, unique_identifiers, number_of_doubles)
-                individual_doubles.print_doubles(doubles)
-            if validation_options is not None:
-                PopulationValidator().validate(population, validation_options, unique_identifiers)
+    cache = PopulationCache(inputfile, cache_directory) if use_cache else None
+    if serve or socket_path is not None:
+        server = QueryServer(inputfile, cache, jobs, ancestor_index)
+        server.population = load_population(inputfile, cache, rebuild_cache, jobs, ancestor_index)
+        server.mtime = os.stat(inputfile).st_mtime_ns
+        if socket_path is not None:
+            try:
+                server.serve_socket(socket_path)
+            except ValueError as e:
+                print(str(e))
+                sys.exit(2)
         else:
-            name = names[0]
-            if population.is_identifier(name):
-                identifier = name
-                name = population.get_name(identifier)
-                if name is None:
-                    name = "unknown"
+            server.serve_stream(sys.stdin, sys.stdout)
+        return
+    if profile or profile_file is not None:
+        profiler.enabled = True
+        sys.stdout = LineCounter(sys.stdout)
+
+    if merge_file is None and diff_file is None:
+        with profiler.phase("load"):
+            if sqlite_file is not None:
+                try:
+                    population = load_sqlite_population(inputfile, sqlite_file, rebuild_cache, jobs)
+                except ValueError as e:
+                    print(str(e))
+                    sys.exit(2)
+                if ancestor_index:
+                    population.build_ancestor_index()
+            elif batch_file is None and not ancestor_index and names is not None and len(names) == 1 and not show_unconnected and not show_longest_branch:
+                index_cache = PopulationCache(inputfile, cache_directory, ".index", False) if use_cache else None
+                population = LazyPopulation(inputfile, load_record_index(inputfile, index_cache, rebuild_cache))
             else:
-                name = population.find_closest_match(name)
-                identifier = population.get_identifier(name)
-            print("Name = " + name)
-            population.print_identifier(identifier)
-            if show_unconnected:
-                unconnected = UnconnectedIndividuals().find(population, identifier, direct)
-                print("Unconnected with " + name + ":")
-                for i in unconnected:
-                    name = population.get_name(i)
-                    if name is None:
-                        name = i
-                    married_name = population.get_married_name(i)
-                    if married_name is not None:
-                        married_name = " (" + married_name + ")"
-                    else:
-                        married_name = ""
-                    print(name + married_name)
-                print("Found " + str(len(unconnected)) + " unconnected individuals")
-            if show_longest_branch:
-                longest_branch = population.find_longest_branch(identifier)
-                for i in longest_branch:
-                    print(population.apply_format(i, format))
-    elif number_of_doubles is not None:
-        i = IndividualDoubles()
-        identifiers = population.get_identifiers()
-        doubles = i.get_doubles(population, identifiers, number_of_doubles)
-        i.print_doubles(doubles)
-    elif validation_options is not None:
-        PopulationValidator().validate(population, validation_options)
+                population = load_population(inputfile, cache, rebuild_cache, jobs, ancestor_index)
+    
+    if merge_file is not None:
+        with profiler.phase("merge"):
+            merger = merge_gedcom(inputfile, merge_file, outputfile)
+            print("Merged " + str(merger.merged) + " duplicate records and rewrote " +
+                  str(merger.references) + " references into " + outputfile)
+    elif diff_file is not None:
+        with profiler.phase("diff"):
+            RecordDiff(output_format).diff_files(diff_file, inputfile, sys.stdout)
+    elif batch_file is not None:
+        with profiler.phase("batch"):
+            with open(batch_file) as f:
+                queries = QueryBatch().read_queries(f)
+            QueryBatch(jobs).run_queries(population, queries, sys.stdout)
+    elif relationship_file is not None:
+        with profiler.phase("relationships"):
+            print_relationships(population, relationship_file, output_format)
+    else:
+        run_query(population, names, format, output_format, show_unconnected, direct, show_longest_branch,
+                  show_relationship, show_components, number_of_doubles, validation_options, jobs)
+
+    if profiler.enabled:
+        sys.stdout.flush()
+        profiler.count("lines_emitted", sys.stdout.lines)
+        sys.stdout = sys.stdout.stream
+        if profile_file is not None:
+            with open(profile_file, 'w') as f:
+                json.dump(profiler.to_dict(), f, indent=2)
+        else:
+            profiler.print_report(sys.stderr)
 
 if __name__ == "__main__":
    main(sys.argv[1:])
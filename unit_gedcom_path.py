@@ -1,6 +1,72 @@
-import unittest
+import unittest, io, os, json, tempfile, contextlib
 
 import gedcom_path
+import benchmark_gedcom_path
+
+GEDCOM = """0 HEAD
+0 @I1@ INDI
+1 NAME John /Smith/
+1 BIRT
+2 DATE 12 MAR 1850
+1 SEX M
+1 OCCU Farmer
+1 FAMS @F1@
+0 @I2@ INDI
+1 NAME Mary /Jones/
+1 BIRT
+2 DATE ABT 1852
+1 SEX F
+1 FAMS @F1@
+0 @I3@ INDI
+1 NAME Peter /Smith/
+1 BIRT
+2 DATE 1875
+1 SEX M
+1 FAMC @F1@
+1 FAMS @F2@
+0 @I4@ INDI
+1 NAME Anna /Berg/
+1 BIRT
+2 DATE 1876
+1 SEX F
+1 FAMS @F2@
+0 @I5@ INDI
+1 NAME Olav /Smith/
+1 BIRT
+2 DATE 1901
+1 SEX M
+1 FAMC @F2@
+0 @I6@ INDI
+1 NAME Olaf /Smith/
+1 BIRT
+2 DATE 1902
+1 SEX M
+0 @I7@ INDI
+1 NAME Ola /Smith/
+1 BIRT
+2 DATE 1903
+1 SEX M
+0 @F1@ FAM
+1 HUSB @I1@
+1 WIFE @I2@
+1 CHIL @I3@
+0 @F2@ FAM
+1 HUSB @I3@
+1 WIFE @I4@
+1 CHIL @I5@
+0 TRLR
+"""
+
+def parse_population():
+    population = gedcom_path.Population()
+    gedcom_path.FileParser().parse_file(io.StringIO(GEDCOM), population)
+    return population
+
+def write_gedcom(directory, text=GEDCOM):
+    filename = os.path.join(directory, "test.ged")
+    with open(filename, "w") as f:
+        f.write(text)
+    return filename
 
 class IndividualDoubles(unittest.TestCase):
 
@@ -14,6 +80,336 @@ class IndividualDoubles(unittest.TestCase):
         y = gedcom_path.DateParser()
         print(y.parse("1989"))
         print(y.parse("ABT 1989"))
+        assert(y.parse("12 MAR 1850").get_year() == 1850)
+        assert(str(y.parse("CAL 1850")) == "1850")
+        assert(y.parse("BET 1850 AND 1855").get_year_range() == (1850, 1855))
+        assert(y.parse("INT 1850 (about then)").get_year() == 1850)
+        assert(y.parse("1750/51").get_year() == 1751)
+        assert(y.parse("1699/00").get_year_range() == (1700, 1700))
+        assert(y.parse("31 FEB 1850").get_year_range() is None)
+        assert(y.parse("1857").year_difference(y.parse("BET 1850 AND 1855")) == 2)
+        population = gedcom_path.Population()
+        gedcom_path.FileParser().parse_file(io.StringIO(GEDCOM.replace("2 DATE 1901", "2 DATE")), population)
+        assert(population.apply_format("@I5@", "%n %b") == "Olav Smith ")
+
+    def test_tokenize(self):
+        y = gedcom_path.LineParser(chunk_size=7)
+        t = "0 @I1@ INDI\n\n1 NOTE first\npart two\n1 SEX M\n"
+        s = list(y.tokenize(io.StringIO(t)))
+        assert(len(s) == 3)
+        assert(s[0] == (0, ["@I1@", "INDI"], "INDI", 1))
+        assert(s[1].rest == "firstpart two")
+        assert(s[2].command == ["SEX", "M"])
         
+    def test_get_doubles(self):
+        population = parse_population()
+        y = gedcom_path.IndividualDoubles()
+        doubles = y.get_doubles(population, list(population.get_identifiers()), 5)
+        assert([(i[2], i[4]) for i in doubles] == [("@I6@", "@I7@"), ("@I5@", "@I6@")])
+
+    def test_parallel_doubles(self):
+        population = gedcom_path.Population()
+        names = ["Olav", "Olaw", "Oluf", "Ole", "Olai", "Olve"]
+        text = "".join("0 @I" + str(8 + k) + "@ INDI\n1 NAME " + i + " /Smith/\n1 BIRT\n2 DATE 1901\n" for k, i in enumerate(names))
+        gedcom_path.FileParser().parse_file(io.StringIO(GEDCOM.replace("0 TRLR", text + "0 TRLR")), population)
+        y = gedcom_path.IndividualDoubles()
+        y.dot_size = 2
+        identifiers = list(population.get_identifiers())
+        with contextlib.redirect_stdout(io.StringIO()) as output:
+            doubles = y.get_doubles(population, identifiers, 4, 2)
+        # More batches than the window of two per worker
+        assert(output.getvalue().splitlines()[1].count(".") > 2 * 2)
+        assert(doubles == y.get_doubles(population, identifiers, 4))
+
+    def test_vectorized_candidates(self):
+        population = parse_population()
+        identifiers = list(population.get_identifiers())
+        y = gedcom_path.IndividualDoubles()
+        pruned = list(y.get_pruned_candidates(population, identifiers, [], 0))
+        assert(((5, "@I6@"), (6, "@I7@")) in pruned)
+        if gedcom_path.numpy is not None:
+            assert(sorted(y.get_vectorized_candidates(population, identifiers, [], 0)) == sorted(pruned))
+
+    def test_name_index(self):
+        population = parse_population()
+        assert(population.get_identifier("Peter Smith") == "@I3@")
+        assert(population.get_identifier("Nobody") is None)
+        assert(population.find_closest_match("petr smith") == "Peter Smith")
+
+    def test_population_storage(self):
+        population = parse_population()
+        peter = population.get_id("@I3@")
+        assert(population.get_identifiers_at(population.get_child_ids(peter)) == ["@I5@"])
+        assert(population.get_identifiers_at(population.get_parent_ids(peter)) == ["@I1@", "@I2@"])
+        assert(population.get_spouses("@I3@") == ["@I4@"])
+        assert(population.get_parents("@I1@") == [None, None])
+
+    def test_get_branches(self):
+        population = parse_population()
+        branches = population.get_branches("John Smith", "Olav Smith", ["Peter Smith"])
+        assert(branches == [["@I5@", "@I3@", "@I1@"]])
+        assert(population.get_branches("John Smith", "Olav Smith", ["Anna Berg"]) == [])
+        assert(population.get_branches("Olav Smith", "John Smith", []) == [])
+
+    def test_find_longest_branch(self):
+        population = parse_population()
+        assert(population.find_longest_branch("@I5@") == ["@I1@", "@I3@", "@I5@"])
+        assert(population.find_longest_branches(["@I3@", "@I6@"]) == [["@I1@", "@I3@"], ["@I6@"]])
+
+    def test_connected_components(self):
+        population = parse_population()
+        components = gedcom_path.ConnectedComponents(population)
+        assert(components.get_sizes() == [5, 1, 1])
+        assert(components.get_component_id("@I1@") == components.get_component_id("@I4@"))
+        unconnected = gedcom_path.UnconnectedIndividuals().find(population, "@I3@", True)
+        assert(sorted(unconnected) == ["@I4@", "@I5@", "@I6@", "@I7@"])
+
+    def test_validate(self):
+        population = gedcom_path.Population()
+        text = GEDCOM.replace("2 DATE 1901", "2 DATE 1860").replace("0 TRLR", "0 @I8@ INDI\n1 FAMC @F1@\n1 FAMC @F3@\n0 TRLR")
+        gedcom_path.FileParser().parse_file(io.StringIO(text), population)
+        validator = gedcom_path.PopulationValidator()
+        findings = validator.get_findings(population, ["all"])
+        assert(("birth_order", "@I5@", "father @I3@ was born after the child") in findings)
+        assert(("duplicate_famc", "@I8@", "multiple FAMC: @F1@, @F3@") in findings)
+        assert(("dangling_xref", "@I8@", "FAMC @F3@ does not exist") in findings)
+        assert(("gender", "@I8@", "gender is missing") in findings)
+        output = io.StringIO()
+        validator.validate(population, ["gender"], ["@I1@", "@I8@"], "csv", output)
+        assert(output.getvalue() == "rule,identifier,name,message\ngender,@I8@,,gender is missing\n")
+
+    def test_merge(self):
+        merger = gedcom_path.IndividualMerger().read_pairs(io.StringIO("(90, 'Olav Smith', '@I5@', 'Olaf Smith', '@I6@', 0)\n@I6@,@I7@\n"))
+        output = io.StringIO()
+        merger.merge_file(io.StringIO(GEDCOM.replace("1 SEX M\n0 @I7@", "1 SEX M\n1 OCCU Fisher\n0 @I7@")), output)
+        assert(merger.merged == 2)
+        population = gedcom_path.Population()
+        gedcom_path.FileParser().parse_file(io.StringIO(output.getvalue()), population)
+        assert(sorted(population.get_identifiers()) == ["@I1@", "@I2@", "@I3@", "@I4@", "@I5@"])
+        assert(population.get_name("@I5@") == "Olav Smith")
+        assert(population.get_occupation("@I5@") == ["Fisher"])
+        assert(population.get_children("@I3@") == ["@I5@"])
+
+    def test_diff(self):
+        text = GEDCOM.replace("2 DATE 1901", "2 DATE 1902\n1 CHAN\n2 DATE 1 JAN 2026").replace("\n", "\r\n")
+        text = text.replace("1 CHIL @I5@", "1 CHIL @I5@\r\n1 CHIL @I6@").replace("1 OCCU Farmer", "1 OCCU Farmer\r\n1 NOTE Vik")
+        text = text.replace("0 @I7@ INDI\r\n1 NAME Ola /Smith/", "0 @I8@ INDI\r\n1 NAME Kari /Smith/")
+        output = io.StringIO()
+        gedcom_path.RecordDiff("json").diff_data(GEDCOM.encode(), text.encode(), output)
+        changes = [json.loads(i) for i in output.getvalue().splitlines()]
+        assert([(i["change"], i["identifier"]) for i in changes[:-1]] ==
+               [("modified", "@I1@"), ("modified", "@I5@"), ("added", "@I8@"), ("modified", "@F2@"), ("removed", "@I7@")])
+        assert(changes[0]["fields"] == {"lines": [[], ["1 NOTE Vik"]]})
+        assert(changes[1]["fields"] == {"birthday": ["1901", "1902"]})
+        assert(changes[3]["fields"] == {"children": [["@I5@"], ["@I5@", "@I6@"]]})
+        assert(changes[-1]["counts"]["family"] == {"added": 0, "removed": 0, "modified": 1})
+
+    def test_relationships(self):
+        population = parse_population()
+        relationships = gedcom_path.Relationships(population)
+        relationship = relationships.get_relationship("@I5@", "@I1@")
+        assert(relationship["relationship"] == "grandson")
+        assert(relationship["path"] == ["@I5@", "@I3@", "@I1@"])
+        assert(relationship["common_ancestors"] == ["@I1@"])
+        assert(relationships.get_relationship("@I4@", "@I3@")["relationship"] == "wife")
+        assert(relationships.get_relationship("@I1@", "@I4@")["relationship"] == "related by marriage")
+        assert(relationships.get_relationship("@I6@", "@I1@")["relationship"] is None)
+        assert(relationships.get_relationship_name("@I6@", (3, 4)) == "2nd cousin once removed")
+        assert(relationships.get_relationship_name("@I2@", (1, 4)) == "2nd great-aunt")
+
+    def test_print_branches(self):
+        population = parse_population()
+        tree = [["@I5@", "@I3@", "@I1@"], ["@I3@", "@I1@"]]
+        output = io.StringIO()
+        population.print_branches(tree, "%n %b", "dot", output)
+        assert(output.getvalue().splitlines() == ["digraph family_tree {", '"Olav Smith 1901" -> "Peter Smith 1875"',
+                                                 '"Peter Smith 1875" -> "John Smith 1850"', "}"])
+        output = io.StringIO()
+        population.print_branches(tree, "%n%o", "json", output)
+        result = json.loads(output.getvalue())
+        assert(result["branches"] == tree)
+        assert(result["individuals"]["@I1@"] == "John SmithFarmer, ")
+
+    def test_synthetic_gedcom(self):
+        output = io.StringIO()
+        benchmark_gedcom_path.SyntheticGedcom(200, generations=5, seed=3).generate().write(output)
+        population = gedcom_path.Population()
+        gedcom_path.FileParser().parse_file(io.StringIO(output.getvalue()), population)
+        assert(population.get_size() == 200)
+        assert(len(population.find_longest_branch(list(population.get_identifiers())[-1])) == 5)
+
+class PopulationLoading(unittest.TestCase):
+
+    def test_population_cache(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_gedcom(directory)
+            cache = gedcom_path.PopulationCache(filename, os.path.join(directory, "cache"))
+            assert(cache.load() is None)
+            population = gedcom_path.load_population(filename, cache)
+            cached = cache.load()[0]
+            assert(cached is not None)
+            assert(cached.get_children("@I3@") == population.get_children("@I3@"))
+            with open(filename, "a") as f:
+                f.write("0 @I8@ INDI\n")
+            assert(cache.load() is None)
+
+    def test_incremental_parse(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_gedcom(directory)
+            cache = gedcom_path.PopulationCache(filename, os.path.join(directory, "cache"))
+            gedcom_path.load_population(filename, cache)
+            with open(filename, "w") as f:
+                f.write(GEDCOM.replace("Peter /Smith/", "Petter /Smith/").replace("0 TRLR", "0 @I8@ INDI\n1 NAME Eva /Smith/\n1 FAMC @F2@\n0 TRLR"))
+            population = gedcom_path.Population()
+            parser = gedcom_path.IncrementalFileParser(cache.read()[1][1])
+            cache.save((population, parser.parse_file(filename, population)))
+            assert(parser.parsed == 2)
+            full = gedcom_path.parse_population(filename)
+            assert(population.xrefs == full.xrefs)
+            assert(population.get_name("@I3@") == "Petter Smith")
+            assert(population.get_children("@I3@") == full.get_children("@I3@"))
+
+    def test_parallel_parse(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_gedcom(directory)
+            population = gedcom_path.Population()
+            gedcom_path.IncrementalFileParser(jobs=2, chunk_size=3).parse_file(filename, population)
+            full = parse_population()
+            assert(population.xrefs == full.xrefs)
+            assert(list(population.fathers) == list(full.fathers))
+            assert(population.get_spouses("@I3@") == ["@I4@"])
+            assert(str(population.individuals["@I2@"].birthday) == "1852")
+
+    def test_lazy_population(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_gedcom(directory)
+            record_index = gedcom_path.RecordIndex().build(filename)
+            assert(record_index.names["@I3@"] == "Peter Smith")
+            population = gedcom_path.LazyPopulation(filename, record_index)
+            identifier = population.resolve_identifier("Peter Smith")
+            assert(population.get_parents(identifier) == ["@I1@", "@I2@"])
+            assert(population.get_children(identifier) == ["@I5@"])
+            assert(population.get_spouses(identifier) == ["@I4@"])
+            assert("@I6@" not in population.ids)
+            population.data.close()
+
+    def test_lazy_population_without_back_pointers(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_gedcom(directory, GEDCOM.replace("1 FAMC @F1@\n", "").replace("1 FAMS @F1@\n", ""))
+            population = gedcom_path.LazyPopulation(filename, gedcom_path.RecordIndex().build(filename))
+            assert(population.get_father("@I3@") == "@I1@")
+            assert(population.get_children("@I1@") == ["@I3@"])
+            assert(population.get_spouses("@I2@") == ["@I1@"])
+            population.data.close()
+
+class AncestorIndex(unittest.TestCase):
+
+    def test_ancestor_index(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_gedcom(directory)
+            cache = gedcom_path.PopulationCache(filename, os.path.join(directory, "cache"))
+            gedcom_path.load_population(filename, cache)
+            population = gedcom_path.load_population(filename, cache, ancestor_index=True)
+            assert(cache.load()[0].ancestor_index is not None)
+        index = population.ancestor_index
+        i1, i3, i4, i5, i6 = [population.get_id(i) for i in ("@I1@", "@I3@", "@I4@", "@I5@", "@I6@")]
+        assert(index.is_ancestor(i1, i5) and not index.is_ancestor(i5, i1) and not index.is_ancestor(i6, i5))
+        assert(sorted(population.get_ancestors("@I5@")) == ["@I1@", "@I2@", "@I3@", "@I4@"])
+        assert(index.get_generations(i1, i5) == 2 and index.get_generations(i5, i5) == 0)
+        assert(index.get_generations(i6, i5) is None)
+        assert(index.get_common_ancestors(i3, i4) == [] and index.get_common_ancestors(i5, i3) == [i3])
+        assert(population.get_branches("John Smith", "Olav Smith", ["Peter Smith"]) == [["@I5@", "@I3@", "@I1@"]])
+        assert(population.get_branches("John Smith", "Olav Smith", ["Anna Berg"]) == [])
+        unconnected = gedcom_path.UnconnectedIndividuals().find(population, "@I3@", True)
+        assert(sorted(unconnected) == ["@I4@", "@I5@", "@I6@", "@I7@"])
+
+class SqlitePopulation(unittest.TestCase):
+
+    def test_sqlite_population(self):
+        population = parse_population()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_gedcom(directory)
+            database = os.path.join(directory, "test.sqlite")
+            sqlite_population = gedcom_path.load_sqlite_population(filename, database)
+            assert(list(sqlite_population.get_identifiers()) == list(population.get_identifiers()))
+            for i in population.get_identifiers():
+                assert(sqlite_population.get_children(i) == population.get_children(i))
+                assert(sqlite_population.get_parents(i) == population.get_parents(i))
+                assert(sqlite_population.get_spouses(i) == population.get_spouses(i))
+                assert(sqlite_population.apply_format(i, "%n %g %b") == population.apply_format(i, "%n %g %b"))
+            assert(sqlite_population.get_branches("John Smith", "Olav Smith", ["Peter Smith"]) == [["@I5@", "@I3@", "@I1@"]])
+            assert(sqlite_population.find_longest_branch("@I5@") == ["@I1@", "@I3@", "@I5@"])
+            assert(gedcom_path.UnconnectedIndividuals().find(sqlite_population, "@I5@", False) == ["@I6@", "@I7@"])
+            doubles = gedcom_path.IndividualDoubles().get_doubles(sqlite_population, sqlite_population.get_identifiers(), 5)
+            assert(doubles == gedcom_path.IndividualDoubles().get_doubles(population, population.get_identifiers(), 5))
+            assert(gedcom_path.SqlitePopulation(database).is_loaded(filename))
+            with self.assertRaises(ValueError):
+                gedcom_path.SqlitePopulation(filename).load(filename)
+
+class QueryServer(unittest.TestCase):
+
+    def test_query_server(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_gedcom(directory)
+            server = gedcom_path.QueryServer(filename)
+            requests = io.StringIO('{"id": 1, "operation": "longest_branch", "names": ["Olav"]}\n'
+                                   '{"id": 2, "operation": "unknown"}\n[1]\n'
+                                   '{"id": 3, "operation": "person", "names": ["Olav"]}\n')
+            output = io.StringIO()
+            server.serve_stream(requests, output)
+            responses = [json.loads(i) for i in output.getvalue().splitlines()]
+            assert([i["identifier"] for i in responses[0]["result"]] == ["@I1@", "@I3@", "@I5@"])
+            assert("error" in responses[1])
+            assert(responses[2] == {"id": None, "error": "Invalid request"} and responses[3]["id"] == 3)
+
+    def test_query_server_reload(self):
+        with tempfile.TemporaryDirectory() as directory:
+            filename = write_gedcom(directory)
+            cache = gedcom_path.PopulationCache(filename, os.path.join(directory, "cache"))
+            server = gedcom_path.QueryServer(filename, cache, ancestor_index=True)
+            assert(server.get_population().ancestor_index is not None)
+            write_gedcom(directory, GEDCOM.replace("0 TRLR", "0 @I8@ INDI\n1 NAME Eva /Smith/\n1 FAMC @F2@\n0 TRLR"))
+            os.utime(filename, ns=(server.mtime + 10 ** 9, server.mtime + 10 ** 9))
+            population = server.get_population()
+            assert(population.is_identifier("@I8@") and population.ancestor_index is not None)
+            assert(cache.load()[0].ancestor_index is not None)
+
+    def test_query_batch(self):
+        population = parse_population()
+        with tempfile.TemporaryDirectory() as directory:
+            filename = os.path.join(directory, "branches.json")
+            queries = gedcom_path.QueryBatch().read_queries(io.StringIO(
+                '{"names": "Olav", "longest_branch": true, "format": "%n %b"}\n\n'
+                '{"names": ["Olav", "John"], "output_format": "json", "output": "' + filename + '"}\n'
+                '{"output_format": "unknown"}\nnot json\n[1]\n{"names": "John"}\n'))
+            output = io.StringIO()
+            gedcom_path.QueryBatch(2).run_queries(population, queries, output)
+            responses = [json.loads(i) for i in output.getvalue().splitlines()]
+            assert([i["id"] for i in responses] == [1, 3, 4, 5, 6, 7])
+            assert(responses[0]["result"].endswith("John Smith 1850\nPeter Smith 1875\nOlav Smith 1901\n"))
+            with open(filename) as f:
+                assert(json.load(f)["branches"] == [["@I5@", "@I3@", "@I1@"]])
+            assert("error" in responses[2])
+            assert(responses[3]["error"].startswith("Invalid query: ") and responses[4] == {"id": 6, "error": "Invalid query"})
+            assert("result" in responses[5])
+
+class Profiler(unittest.TestCase):
+
+    def test_profile(self):
+        profiler = gedcom_path.profiler
+        gedcom_path.profiler = gedcom_path.Profiler()
+        try:
+            with tempfile.TemporaryDirectory() as directory:
+                filename = write_gedcom(directory)
+                with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()) as report:
+                    gedcom_path.main(["-f", filename, "--no-cache", "-n", "Olav", "-u", "--profile"])
+        finally:
+            gedcom_path.profiler = profiler
+        lines = report.getvalue().splitlines()
+        assert([i.split()[0] for i in lines[:6]] == ["load", "parse", "link", "match_names", "unconnected", "total"])
+        assert(lines[1].startswith("  parse") and lines[0].endswith("kB peak RSS (process)"))
+        counters = dict(i.split() for i in lines[6:])
+        assert(counters["records"] == "11" and counters["individuals"] == "7" and counters["families"] == "2")
+
 if __name__ == '__main__':
     unittest.main()